@@ -31,6 +31,9 @@ For instructions please consult the readme!
 '''
 
 
+import sys
+from contextlib import redirect_stdout
+
 import cv2
 
 from pyspectrometer2.app import App
@@ -38,19 +41,56 @@ from pyspectrometer2.app import App
 from .exceptions import CalibrationError
 
 from .spectrometer import Spectrometer
-from . import cli,record,video
-
-args = cli.args()
-
+from . import bench,cli,headless,record,video
+
+
+def open_source(args):
+    pacing = 'realtime' if args.realtime else 'fast'
+    if args.video:
+        return video.VideoFile(args.video,pacing=pacing)
+    if args.images:
+        return video.ImageDirectory(args.images,fps=args.fps,pacing=pacing)
+    if args.synthetic:
+        lines = video.SyntheticSpectrum.default_lines
+        if args.lines:
+            #only wavelengths given, reuse a typical height and width
+            lines = [(float(nm),200,2) for nm in args.lines.split(',')]
+        return video.SyntheticSpectrum(args.width,args.height,args.fps,lines=lines,pacing=pacing)
 
-def main():
     capture = video.Capture.initialize(args.device,args.width,args.height,args.fps)
-    print(capture)
     if capture.width != args.width:
         raise RuntimeError(f"Unable to open device /dev/video{args.device} with width={args.width}.")
+    return capture
+
 
-    calibration = record.Calibration(capture.width)
-    s = Spectrometer(calibration)
+def main():
+    args = cli.args()
+    if args.command == "bench":
+        widths = [int(w) for w in args.widths.split(',')]
+        bench.run(widths,frames=args.frames,output=args.output,display_width=args.display_width)
+        return
+
+    #in headless mode stdout may be the data stream, so keep chatter on stderr
+    with redirect_stdout(sys.stderr if args.headless else sys.stdout):
+        capture = open_source(args)
+        print(capture)
+        if args.reader:
+            capture.start_reader(policy=args.reader)
+
+        calibration = record.Calibration(capture.width,order=args.cal_order)
+    s = Spectrometer(calibration, sample_count=args.sample_rows, channel=args.channel, peak_method=args.peak_fit)
+    s.correction.load()
+    compression = 'zlib' if args.compress else None
+    if args.record:
+        s.start_recording(args.record,compression=compression)
+
+    if args.headless:
+        if args.output:
+            with open(args.output,'w') as output:
+                headless.run(s,capture,output=output,flip=args.flip)
+        else:
+            headless.run(s,capture,flip=args.flip)
+        return
 
     if args.fullscreen:
         print("Fullscreen Spectrometer enabled")
@@ -60,7 +100,11 @@ def main():
         capture=capture,
         fullscreen=args.fullscreen,
         waterfall=args.waterfall,
-        flip=args.flip)
+        flip=args.flip,
+        record_compression=compression,
+        display_rate=args.display_rate,
+        display_width=args.display_width)
     app.run()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
-from pyspectrometer2 import ui, video
+import time
+
+from pyspectrometer2 import record, render, ui, video
+from pyspectrometer2.display import DisplayAxis
+from pyspectrometer2.history import History
 from pyspectrometer2.interactivity import SpectrometerInteractivity
-from pyspectrometer2.specFunctions import peakIndexes, savitzky_golay, wavelength_to_rgb
+from pyspectrometer2.metrics import Timings
 from pyspectrometer2.spectrometer import Spectrometer
 
 import cv2
@@ -16,23 +20,52 @@ class App:
     waterfall_title: str = 'PySpectrometer 2 - Waterfall'
     font=cv2.FONT_HERSHEY_SIMPLEX
 
-    def __init__(self,s: Spectrometer, capture: video.Capture, fullscreen=False, waterfall=False, flip=False):
+    def __init__(self,s: Spectrometer, capture: video.FrameSource, fullscreen=False, waterfall=False, flip=False, record_compression=None, display_rate=None, display_width=None):
         self.s = s
-        self.history = np.zeros([self.graphHeight,s.calibration.width,3],dtype=np.uint8)
-        self.history.fill(0) #fill black
+        #processing stays at the sensor's width, the windows are drawn display.width wide
+        self.display = DisplayAxis(s.calibration,display_width)
+        width = self.display.width
+        self.history = History(self.graphHeight,[width,3]) #waterfall rows, black to start
+        #snapshots copy the history into one of these, the waterfall renderer may be drawing from the other
+        self.waterfall_buffers = [np.zeros([self.graphHeight,width,3],dtype=np.uint8) for _ in range(2)]
+        self.graticule = ui.Graticule(font=self.font)
         self.capture = capture
         self.capture.preview_height = min(self.capture.height,self.previewHeight)
+
+        #two canvases per window, one on screen while a render thread draws the other
+        self.spectrum_canvases = [ui.Compositor(width,self.messageHeight,self.capture.preview_height,self.graphHeight) for _ in range(2)]
+        self.waterfall_canvases = [ui.Compositor(width,self.messageHeight,self.capture.preview_height,self.graphHeight) for _ in range(2)]
+        #scratch for the spectrum's render thread
+        self.graph_rows = np.arange(self.graphHeight)[:,None]
+        self.graph_mask = np.zeros([self.graphHeight,width],dtype=bool)
+        #outline points, x fixed, y per frame. When decimating it zigzags through each column's max and min
+        columns = np.arange(width) if self.display.identity else np.repeat(np.arange(width),2)
+        self.trace = np.zeros([len(columns),2],dtype=np.int32)
+        self.trace[:,0] = 2*columns
+        self.s.spectrum_vertical = self.spectrum_canvases[0].canvas
+        self.s.waterfall_vertical = self.waterfall_canvases[0].canvas
+        #takes the mouse events, each frame's overlay is drawn from a snapshot of its cursor and clicks
+        self.overlay = ui.Overlay(self.s.spectrum_vertical,
+                            width,
+                            message_height=self.messageHeight,
+                            preview_height=self.previewHeight)
+        self.renderers = []
         self.saveMsg = "No saves"
+        self.snapshots = record.SnapshotWriter()
 
         #preferences
         self.fullscreen = fullscreen
         self.waterfall = waterfall
         self.flip = flip
+        self.record_compression = record_compression
+        self.display_rate = display_rate #Hz the windows are redrawn at, None for every frame
+        self.display_timings = Timings(maxlen=100) #ticks once per redraw
 
         #modes and views
         self.holdpeaks: bool = False #are we holding peaks?
         self.measure: bool = False #are we measuring?
         self.recPixels: bool = False #are we measuring pixels and recording clicks?
+        self.interactivity = SpectrometerInteractivity(self)
 
     def run(self):
         self.setup_windows()
@@ -54,41 +87,66 @@ class App:
        return self.graphHeight+self.previewHeight+self.messageHeight
 
     def update_windows(self):
-        while(self.capture.isOpened()):
-            # Capture frame-by-frame
-            success, frame = self.capture.read()
-            if not success:
-                break
-
-            if self.flip:
-                FLIP_ABOUT_X_AXIS = 0
-                FLIP_ABOUT_Y_AXIS = 1
-                frame = cv2.flip(frame,flipCode=FLIP_ABOUT_Y_AXIS)
-
-            self.update_spectrum_window(frame=frame)
-
-            if self.waterfall:
-                self.update_waterfall_window(frame=frame)
-
-
-            keyPress = cv2.waitKey(1)
-            if keyPress == ord('q'):
-                break
-            if self.close_event():
-                break
-            si = SpectrometerInteractivity(self)
-            si.handle_keypress(keyPress)
-
-
-        #Everything done, release the vid
-        self.capture.release()
-        cv2.destroyAllWindows()
+        timings = self.s.timings
+        display_interval = 1/self.display_rate if self.display_rate else 0
+        next_display = 0
+        try:
+            while(self.capture.isOpened()):
+                # Capture frame-by-frame
+                with timings.stage('capture'):
+                    success, frame = self.capture.read()
+                    if not success:
+                        break
+
+                    if self.flip:
+                        FLIP_ABOUT_X_AXIS = 0
+                        FLIP_ABOUT_Y_AXIS = 1
+                        frame = cv2.flip(frame,flipCode=FLIP_ABOUT_Y_AXIS)
+
+                #every frame is processed, the windows are only redrawn at the display rate
+                self.s.process(self.capture.cropped_preview(frame),self.capture.frame.timestamp)
+                if self.waterfall:
+                    with timings.stage('history'):
+                        self.push_waterfall()
+                timings.tick()
+
+                now = time.perf_counter()
+                if now < next_display:
+                    continue
+                next_display = max(next_display + display_interval, now) if display_interval else 0
+
+                #drawn on the render threads while the next frames are captured and processed
+                with timings.stage('snapshot'):
+                    snapshot = self.snapshot(frame)
+                for renderer in self.renderers:
+                    renderer.submit(snapshot)
+
+                with timings.stage('display'):
+                    if self.show_windows():
+                        self.display_timings.tick()
+                    keyPress = cv2.waitKey(1)
+
+                if keyPress == ord('q'):
+                    break
+                if self.close_event():
+                    break
+                self.interactivity.handle_keypress(keyPress)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            #Everything done, release the vid, however the loop ended
+            for renderer in self.renderers:
+                renderer.stop()
+            self.s.stop_recording()
+            self.snapshots.close()
+            self.capture.release()
+            cv2.destroyAllWindows()
 
     def setup_windows(self):
         if self.waterfall:
             #waterfall first so spectrum is on top
             cv2.namedWindow(self.waterfall_title,cv2.WINDOW_GUI_NORMAL)
-            cv2.resizeWindow(self.waterfall_title,self.capture.width,self.stackHeight)
+            cv2.resizeWindow(self.waterfall_title,self.display.width,self.stackHeight)
             cv2.moveWindow(self.waterfall_title,200,200)
 
         if self.fullscreen:
@@ -96,160 +154,177 @@ class App:
             cv2.setWindowProperty(self.spectrograph_title,cv2.WND_PROP_FULLSCREEN,cv2.WINDOW_FULLSCREEN)
         else:
             cv2.namedWindow(self.spectrograph_title,cv2.WINDOW_GUI_NORMAL)
-            cv2.resizeWindow(self.spectrograph_title,self.capture.width,self.stackHeight)
+            cv2.resizeWindow(self.spectrograph_title,self.display.width,self.stackHeight)
             cv2.moveWindow(self.spectrograph_title,0,0)
 
+        #listen for click on plot window
+        cv2.setMouseCallback(self.spectrograph_title,self.overlay.handle_mouse)
 
-    def update_spectrum_window(self, frame):
-        hline_color=(100,100,100)
-        vminor_color=(200,200,200)
-        vmajor_color=(0,0,0)
-        #blank image for Graph
-        graph = np.zeros([self.graphHeight,self.capture.width,3],dtype=np.uint8)
-        graph.fill(255) #fill white
+        #only imshow and waitKey stay on this thread, HighGUI needs them on one thread
+        self.renderers = [render.Renderer(self.timed(self.render_spectrum,'graph'),self.spectrum_canvases,name='SpectrumRenderer')]
+        if self.waterfall:
+            self.renderers.append(render.Renderer(self.timed(self.render_waterfall,'waterfall'),self.waterfall_canvases,name='WaterfallRenderer'))
 
-        #Display a graticule calibrated with cal data
-        textoffset = 12
-        #vertial lines every whole 10nm
-        for label,x in self.s.tens:
-            cv2.line(graph,(x,15),(x,self.graphHeight),vminor_color,1)
-
-        #vertical lines every whole 50nm
-        for label,x in self.s.fifties:
-            cv2.line(graph,(x,15),(x,self.graphHeight),vmajor_color,1)
-            cv2.putText(graph,f'{label:n}nm',(x-textoffset,12),self.font,0.4,(0,0,0),1, cv2.LINE_AA)
-
-        #horizontal lines
-        start = 64
-        stop=self.graphHeight
-        step=64
-        for y in range(start, stop, step):
-            cv2.line(graph,(0,y),(self.capture.width,y),hline_color,1)
-
-        #Now process the intensity data and display it
-        #intensity = []
-
-        cropped = self.capture.cropped_preview(frame)
-        bwimage = cv2.cvtColor(cropped,cv2.COLOR_BGR2GRAY)
-        sample_count = 3
-        self.s.sample_intensity(bwimage, sample_count=sample_count)
-        #Draw the intensity data :-)
-        #first filter if not holding peaks!
-
-        if not self.s.holdpeaks:
-            self.s.intensity = savitzky_golay(self.s.intensity,17,self.s.savpoly)
-            self.s.intensity = np.array(self.s.intensity)
-            self.s.intensity = self.s.intensity.astype(int)
-            holdmsg = "Holdpeaks OFF"
-        else:
-            holdmsg = "Holdpeaks ON"
 
+    def show_windows(self):
+        "show any newly drawn canvases, True if the spectrum was redrawn"
+        spectrum = self.renderers[0]
+        #wait for the very first frame, the windows aren't visible until something is shown
+        canvas = spectrum.take(wait=spectrum.front is None)
+        if canvas is not None:
+            self.s.spectrum_vertical = canvas.canvas
+            cv2.imshow(self.spectrograph_title,canvas.canvas)
+        if self.waterfall:
+            waterfall = self.renderers[1]
+            waterfall_canvas = waterfall.take(wait=waterfall.front is None)
+            if waterfall_canvas is not None:
+                self.s.waterfall_vertical = waterfall_canvas.canvas
+                cv2.imshow(self.waterfall_title,waterfall_canvas.canvas)
+        return canvas is not None
+
+    def timed(self, draw, stage):
+        def timed_draw(snapshot, canvas):
+            with self.s.timings.stage(stage):
+                draw(snapshot,canvas)
+        return timed_draw
+
+    def display_axis(self):
+        "the display axis for the current calibration"
+        if self.display.calibration is not self.s.calibration:
+            self.display = DisplayAxis(self.s.calibration,self.display.width)
+        return self.display
+
+    def snapshot(self, frame):
+        "copy what the windows are drawn from, so processing can carry on while they are drawn"
+        s = self.s
+        display = self.display_axis()
+        self.graticule = self.graticule.updated(display,display.width,self.graphHeight)
+        timings = s.timings
+        self.saveMsg = self.snapshots.poll() or self.saveMsg
+        labels = {
+            'cal': s.calibration.status(),
+            'sample_y': f"y={self.capture.crop_offset}",
+            'fps': f"FPS: {timings.fps:.0f}/{self.capture.fps} D:{self.display_timings.fps:.0f} {timings.slowest or ''}",
+            'save': self.saveMsg,
+            'hold': "Holdpeaks ON" if s.holdpeaks else "Holdpeaks OFF",
+            'savpoly': f"Savgol Filter: {s.savpoly}",
+            'label_width': f"Label Peak Width: {s.mindist}",
+            'label_threshold': f"Label Threshold: {s.thresh}",
+            'average': s.average_label,
+            'correction': s.correction.label,
+        }
+        #resampled here, only for frames that are displayed
+        preview = display.resample(self.capture.cropped_preview(frame))
+        low, high, mean = display.reduce(s.intensity)
+        return render.Snapshot(
+            preview=render.frozen(preview),
+            intensity=render.frozen(mean),
+            low=None if display.identity else render.frozen(low),
+            high=None if display.identity else render.frozen(high),
+            peaks=render.frozen(display.column(s.peaks)),
+            peak_wavelengths=render.frozen(s.peak_wavelengths),
+            sample_start=s.sample_start,
+            sample_stop=s.sample_stop,
+            calibration=s.calibration,
+            display=display,
+            graticule=self.graticule,
+            labels=labels,
+            measure=self.measure,
+            recPixels=self.recPixels,
+            cursor=(self.overlay.cursor.x,self.overlay.cursor.y),
+            clicks=tuple((c.x,c.y) for c in self.overlay.clicks),
+            waterfall=self.history.latest(self.graphHeight,out=self.waterfall_buffer()) if self.waterfall else None)
+
+    def waterfall_buffer(self):
+        "a waterfall buffer no renderer is drawing from"
+        #a snapshot the renderer hasn't started on is dropped, the new one replaces it anyway,
+        #so at most one buffer is in use and the other is free
+        drawing = self.renderers[1].withdraw() if len(self.renderers) > 1 else None
+        return next(b for b in self.waterfall_buffers if drawing is None or drawing.waterfall is not b)
+
+    def render_spectrum(self, snapshot, canvas):
+        #draw the graph window into canvas (a ui.Compositor) without showing it
+        #start from the cached graticule
+        graticule = snapshot.graticule
+        graph = canvas.body
+        np.copyto(graph,graticule.spectrum)
 
         #now draw the intensity data....
-        index=0
-        for y in self.s.intensity:
-            rgb = wavelength_to_rgb(round(self.s.calibration.wavelengthData[index]))#derive the color from the wvalenthData array
-            r = rgb[0]
-            g = rgb[1]
-            b = rgb[2]
-            #or some reason origin is top left.
-            cv2.line(graph, (index,self.graphHeight), (index,self.graphHeight-y), (b,g,r), 1)
-            cv2.line(graph, (index,319-y), (index,self.graphHeight-y), (0,0,0), 1,cv2.LINE_AA)
-            index+=1
-
-
-        #find peaks and label them
+        #or some reason origin is top left, so column x is filled from row graphHeight-y down
+        top = self.graphHeight - np.clip(snapshot.intensity,0,self.graphHeight)
+        np.greater_equal(self.graph_rows,top,out=self.graph_mask)
+        #per column BGR, derived from the wavelengthData array
+        cv2.copyTo(graticule.fill,self.graph_mask.view(np.uint8),graph)
+        #outline along the top of the fill, half a pixel up (shift=1 gives half pixel coordinates)
+        if snapshot.high is None:
+            self.trace[:,1] = 2*top - 1
+        else:
+            #a decimated column's fill is its mean, the outline spans its max and min so narrow peaks still show
+            self.trace[0::2,1] = 2*(self.graphHeight - np.clip(snapshot.high,0,self.graphHeight)) - 1
+            self.trace[1::2,1] = 2*(self.graphHeight - np.clip(snapshot.low,0,self.graphHeight)) - 1
+        cv2.polylines(graph,[self.trace],False,(0,0,0),1,cv2.LINE_AA,shift=1)
+
+
+        #label the peaks
         textoffset = 12
-        thresh = int(self.s.thresh) #make sure the data is int.
-        indexes = peakIndexes(self.s.intensity, thres=thresh/max(self.s.intensity), min_dist=self.s.mindist)
-        #print(indexes)
-        for y in indexes:
-            height = self.s.intensity[y]
+        heights = snapshot.intensity if snapshot.high is None else snapshot.high
+        for y,wavelength in zip(snapshot.peaks,snapshot.peak_wavelengths):
+            height = heights[y]
             height = 310-height
-            wavelength = round(self.s.calibration.wavelengthData[y],1)
+            wavelength = round(float(wavelength),1) #sub-pixel refined
             cv2.rectangle(graph,((y-textoffset)-2,height),((y-textoffset)+60,height-15),(0,255,255),-1)
             cv2.rectangle(graph,((y-textoffset)-2,height),((y-textoffset)+60,height-15),(0,0,0),1)
-            cv2.putText(graph,str(wavelength)+'nm',(y-textoffset,height-3),self.font,0.4,(0,0,0),1, cv2.LINE_AA)
+            ui.text_cache.put_text(graph,str(wavelength)+'nm',(y-textoffset,height-3),self.font,0.4,(0,0,0),1)
             #flagpoles
             cv2.line(graph,(y,height),(y,height+10),(0,0,0),1)
 
-        self.s.spectrum_vertical = np.vstack((ui.Overlay.background(self.capture.width),cropped, graph))
+        #header and preview go in around the graph
+        canvas.compose(snapshot.preview)
 
-        #stack the images and display the spectrum
-        self.overlay = ui.Overlay(self.s.spectrum_vertical,
-                            self.capture.width,
+        overlay = ui.Overlay(canvas.canvas,
+                            snapshot.display.width,
                             message_height=self.messageHeight,
                             preview_height=self.previewHeight)
-
-
-        #listen for click on plot window
-        cv2.setMouseCallback(self.spectrograph_title,self.overlay.handle_mouse)
-
-        self.overlay.draw_divisions()
-        self.overlay.draw_sample_boundry(self.s.sample_start,self.s.sample_stop)
-        calmsg = self.s.calibration.status()
-        self.overlay.label('cal',calmsg)
-        self.overlay.label('sample_y',f"y={self.capture.crop_offset}")
-        self.overlay.label('fps', f"Framerate: {self.capture.fps}")
-        self.overlay.label('save', self.saveMsg)
-        self.overlay.label('hold', holdmsg)
-        self.overlay.label('savpoly', f"Savgol Filter: {self.s.savpoly}")
-        self.overlay.label('label_width', f"Label Peak Width: {self.s.mindist}")
-        self.overlay.label('label_threshold', f"Label Threshold: {thresh}")
-
-        if self.measure:
-            self.overlay.show_cursor()
-            self.overlay.show_measure(wavelengthData=self.s.calibration.wavelengthData)
-        elif self.recPixels:
-            self.overlay.show_cursor()
-            self.overlay.show_measure()
-            self.overlay.show_calibration_choices()
-
-        cv2.imshow(self.spectrograph_title,self.s.spectrum_vertical)
-
-    def update_waterfall_window(self,frame):
+        overlay.cursor = ui.Coordinates(*snapshot.cursor)
+        overlay.clicks = [ui.Coordinates(x,y) for x,y in snapshot.clicks]
+        overlay.draw_divisions()
+        overlay.draw_sample_boundry(snapshot.sample_start,snapshot.sample_stop)
+        for label,msg in snapshot.labels.items():
+            overlay.label(label,msg)
+
+        if snapshot.measure:
+            overlay.show_cursor()
+            overlay.show_measure(wavelengthData=snapshot.display.wavelengthData)
+        elif snapshot.recPixels:
+            #calibration clicks are labelled with the sensor pixel they will be saved as
+            overlay.show_cursor()
+            overlay.show_measure(pixelData=snapshot.display.pixel)
+            overlay.show_calibration_choices(pixelData=snapshot.display.pixel)
+        return canvas.canvas
+
+    def push_waterfall(self):
+        #one waterfall row for every processed spectrum, whether or not it gets displayed
         #data is smoothed at this point!!!!!!
-        #create an empty array for the data
-        wdata = np.zeros([1,self.capture.width,3],dtype=np.uint8)
-        index=0
-        for i in self.s.intensity:
-            rgb = wavelength_to_rgb(round(self.s.calibration.wavelengthData[index]))#derive the color from the wavelenthData array
-            luminosity = self.s.intensity[index]/255
-            b = int(round(rgb[0]*luminosity))
-            g = int(round(rgb[1]*luminosity))
-            r = int(round(rgb[2]*luminosity))
-            #print(b,g,r)
-            #wdata[0,index]=(r,g,b) #fix me!!! how do we deal with this data??
-            wdata[0,index]=(r,g,b)
-            index+=1
-        self.history = np.insert(self.history, 0, wdata, axis=0) #insert line to beginning of array
-        self.history = self.history[:-1].copy() #remove last element from array
-
-        hsv = cv2.cvtColor(self.history, cv2.COLOR_BGR2HSV)
-
-        #stack the images and display the waterfall
-        cropped = self.capture.cropped_preview(frame)
-        self.s.waterfall_vertical = np.vstack((ui.Overlay.background(self.capture.width),cropped, self.history))
+        #colour each column from the wavelengthData array, scaled by intensity
+        #(the brightest sensor pixel in each display column, so narrow lines don't fade)
+        display = self.display_axis()
+        luminosity = np.asarray(display.maximum(self.s.intensity))/255
+        wdata = np.rint(display.colorData*luminosity[:,None]).clip(0,255)
+        self.history.push(wdata) #newest line goes at the top
+
+    def render_waterfall(self, snapshot, canvas):
+        rows = canvas.body
+        np.copyto(rows,snapshot.waterfall)
+        #Draw the graticule over the top of the image!
+        snapshot.graticule.apply_waterfall(rows)
+
+        #header and preview go in around the waterfall
+        canvas.compose(snapshot.preview)
         #dividing lines...
-        cv2.line(self.s.waterfall_vertical,(0,80),(self.capture.width,80),(255,255,255),1)
-        cv2.line(self.s.waterfall_vertical,(0,160),(self.capture.width,160),(255,255,255),1)
-        #Draw this stuff over the top of the image!
-        #Display a graticule calibrated with cal data
-        textoffset = 12
-
-        #vertical lines every whole 50nm
-        for positiondata in self.s.fifties:
-            for i in range(162,480):
-                if i%20 == 0:
-                    cv2.line(self.s.waterfall_vertical,(positiondata[0],i),(positiondata[0],i+1),(0,0,0),2)
-                    cv2.line(self.s.waterfall_vertical,(positiondata[0],i),(positiondata[0],i+1),(255,255,255),1)
-            cv2.putText(self.s.waterfall_vertical,str(positiondata[1])+'nm',(positiondata[0]-textoffset,475),self.font,0.4,(0,0,0),2, cv2.LINE_AA)
-            cv2.putText(self.s.waterfall_vertical,str(positiondata[1])+'nm',(positiondata[0]-textoffset,475),self.font,0.4,(255,255,255),1, cv2.LINE_AA)
-
-
+        cv2.line(canvas.canvas,(0,80),(snapshot.display.width,80),(255,255,255),1)
+        cv2.line(canvas.canvas,(0,160),(snapshot.display.width,160),(255,255,255),1)
         #cv2.putText(self.s.waterfall_vertical,calmsg1,(490,15),font,0.4,(0,255,255),1, cv2.LINE_AA)
         #cv2.putText(self.s.waterfall_vertical,calmsg3,(490,51),font,0.4,(0,255,255),1, cv2.LINE_AA)
         #cv2.putText(self.s.waterfall_vertical,saveMsg,(490,69),font,0.4,(0,255,255),1, cv2.LINE_AA)
         #cv2.putText(self.s.waterfall_vertical,holdmsg,(640,15),font,0.4,(0,255,255),1, cv2.LINE_AA)
-
-        cv2.imshow(self.waterfall_title,self.s.waterfall_vertical)
\ No newline at end of file
+        return canvas.canvas
@@ -0,0 +1,198 @@
+"""
+Append-only archive of every spectrum, for logging over hours.
+
+File layout:
+    magic (8 bytes) | header length (uint32) | JSON header, padded to 64 bytes | records
+
+The header stores the width, record dtype, the calibration's wavelength of
+every pixel column and the spectrometer settings, once. Each record is a
+float64 timestamp followed by intensity[width].
+
+Uncompressed archives are one flat array of records, so Archive can
+memory-map them and slice by time without copying. With compression='zlib'
+the records are written in chunks of chunk_records, each prefixed by
+(records, compressed bytes, first timestamp, last timestamp) and byte
+shuffled before compressing, which packs float intensities much better.
+"""
+import json
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'PYSPEC2A'
+ALIGN = 64
+CHUNK_HEADER = struct.Struct('<IIdd')
+
+
+def record_dtype(width, dtype):
+    return np.dtype([('timestamp','<f8'),('intensity',np.dtype(dtype),(width,))])
+
+
+def shuffle(records):
+    #byte k of every record together, then byte k+1... so similar bytes sit next to each other
+    raw = records.view(np.uint8).reshape(len(records),records.dtype.itemsize)
+    return np.ascontiguousarray(raw.T).tobytes()
+
+
+def unshuffle(data, dtype, count):
+    raw = np.frombuffer(data,dtype=np.uint8).reshape(dtype.itemsize,count)
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(count)
+
+
+class ArchiveWriter():
+    "appends (timestamp, intensity) records to an archive file"
+
+    compressions = (None,'zlib')
+
+    def __init__(self, filename, wavelengths, settings=None, dtype=np.float32,
+                 compression=None, chunk_records=256, level=1):
+        if compression not in self.compressions:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {self.compressions}")
+        self.filename = filename
+        self.width = len(wavelengths)
+        self.dtype = record_dtype(self.width,dtype)
+        self.compression = compression
+        self.level = level
+        self.count = 0
+        #compressed archives fill a whole chunk before writing it
+        self.chunk = np.zeros(chunk_records if compression else 1,dtype=self.dtype)
+        self.pending = 0
+
+        header = {
+            'version': 1,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'width': self.width,
+            'dtype': np.dtype(dtype).str,
+            'compression': compression,
+            'chunk_records': len(self.chunk),
+            'wavelengths': [float(nm) for nm in wavelengths],
+            'settings': settings or {},
+        }
+        encoded = json.dumps(header).encode()
+        size = len(MAGIC) + 4 + len(encoded)
+        encoded += b' ' * (-size % ALIGN)
+        self.file = open(filename,'wb')
+        self.file.write(MAGIC + struct.pack('<I',len(encoded)) + encoded)
+
+    def append(self, timestamp, intensity):
+        record = self.chunk[self.pending]
+        record['timestamp'] = timestamp
+        record['intensity'] = intensity
+        self.pending += 1
+        self.count += 1
+        if self.pending == len(self.chunk):
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        if not self.pending:
+            return
+        records = self.chunk[:self.pending]
+        if self.compression:
+            payload = zlib.compress(shuffle(records),self.level)
+            self.file.write(CHUNK_HEADER.pack(len(records),len(payload),records['timestamp'][0],records['timestamp'][-1]))
+            self.file.write(payload)
+        else:
+            self.file.write(records.data)
+        self.pending = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush_chunk()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Archive():
+    "read back an archive, memory-mapped when it is uncompressed"
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename,'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a spectrum archive")
+            length, = struct.unpack('<I',f.read(4))
+            self.header = json.loads(f.read(length))
+        self.offset = len(MAGIC) + 4 + length
+        self.wavelengths = np.array(self.header['wavelengths'])
+        self.settings = self.header['settings']
+        self.dtype = record_dtype(self.header['width'],self.header['dtype'])
+        self.compression = self.header['compression']
+        if self.compression:
+            self.index = self.read_index()
+        else:
+            #a partly written record at the end (e.g. after a crash) is ignored
+            with open(filename,'rb') as f:
+                f.seek(0,2)
+                count = (f.tell() - self.offset) // self.dtype.itemsize
+            self._records = np.memmap(filename,dtype=self.dtype,mode='r',offset=self.offset,shape=(count,)) \
+                if count else np.zeros(0,dtype=self.dtype)
+
+    def read_index(self):
+        #(payload offset, records, compressed bytes, first timestamp, last timestamp) per chunk
+        index = []
+        with open(self.filename,'rb') as f:
+            f.seek(self.offset)
+            while True:
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                count, nbytes, first, last = CHUNK_HEADER.unpack(header)
+                index.append((f.tell(),count,nbytes,first,last))
+                f.seek(nbytes,1)
+        return index
+
+    def read_chunks(self, chunks):
+        parts = []
+        with open(self.filename,'rb') as f:
+            for offset,count,nbytes,first,last in chunks:
+                f.seek(offset)
+                data = f.read(nbytes)
+                if len(data) < nbytes:
+                    break
+                parts.append(unshuffle(zlib.decompress(data),self.dtype,count))
+        return np.concatenate(parts) if parts else np.zeros(0,dtype=self.dtype)
+
+    @property
+    def records(self):
+        "every record, a structured array of timestamp and intensity"
+        if self.compression:
+            return self.read_chunks(self.index)
+        return self._records
+
+    def __len__(self):
+        if self.compression:
+            return sum(chunk[1] for chunk in self.index)
+        return len(self._records)
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @property
+    def intensity(self):
+        return self.records['intensity']
+
+    def between(self, start=None, stop=None):
+        """
+        records with start <= timestamp < stop. A view into the memory-mapped
+        file when uncompressed, only the overlapping chunks are decompressed
+        otherwise.
+        """
+        if self.compression:
+            chunks = [c for c in self.index
+                      if (start is None or c[4] >= start) and (stop is None or c[3] < stop)]
+            records = self.read_chunks(chunks)
+        else:
+            records = self._records
+        timestamps = records['timestamp']
+        first = 0 if start is None else np.searchsorted(timestamps,start,side='left')
+        last = len(records) if stop is None else np.searchsorted(timestamps,stop,side='left')
+        return records[first:last]
@@ -0,0 +1,145 @@
+from contextlib import contextmanager, redirect_stdout
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from . import ui
+from .app import App
+from .metrics import Timings
+from .record import Calibration
+from .spectrometer import Spectrometer
+from .video import SyntheticSpectrum
+
+WIDTHS = (640,800,1280,1920)
+#source reads are timed but left out of the total, synthetic frames cost nothing like a camera
+PIPELINE = ('preview','binning','average','correction','filter','peaks','history','snapshot','graph','waterfall')
+
+
+class Allocations(Timings):
+    "records the peak bytes allocated inside each stage instead of its duration"
+
+    @contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            self.samples[name].append(tracemalloc.get_traced_memory()[1] - before)
+
+
+def build(width, height=600, display_width=None):
+    #a 4 point (3rd order) linear calibration across the visible range
+    pixels = [0, width//3, 2*width//3, width-1]
+    wavelengths = list(np.interp(pixels,[0,width-1],[380,750]))
+    with redirect_stdout(sys.stderr):
+        calibration = Calibration(width,pixels=pixels,wavelengths=wavelengths)
+    source = SyntheticSpectrum(width,height,wavelengths=calibration.wavelengthData,seed=0)
+    s = Spectrometer(calibration)
+    app = App(s,capture=source,waterfall=True,display_width=display_width)
+    return source, s, app
+
+
+def run_frames(source, s, app, timings, frames):
+    #every stage in turn on this thread, the GUI overlaps graph and waterfall with the rest
+    s.timings = timings
+    for _ in range(frames):
+        with timings.stage('capture'):
+            success, frame = source.read()
+        with timings.stage('preview'):
+            preview = source.cropped_preview(frame)
+        s.process(preview)
+        with timings.stage('history'):
+            app.push_waterfall()
+        with timings.stage('snapshot'):
+            snapshot = app.snapshot(frame)
+        with timings.stage('graph'):
+            app.render_spectrum(snapshot,app.spectrum_canvases[0])
+        with timings.stage('waterfall'):
+            app.render_waterfall(snapshot,app.waterfall_canvases[0])
+        timings.tick()
+
+
+def summarize(samples):
+    seconds = np.asarray(samples,dtype=float)
+    return {
+        'fps': float(1/seconds.mean()) if seconds.mean() else None,
+        'mean_ms': float(seconds.mean()*1000),
+        'p50_ms': float(np.percentile(seconds,50)*1000),
+        'p99_ms': float(np.percentile(seconds,99)*1000),
+    }
+
+
+def bench_width(width, frames, warmup, display_width=None):
+    source, s, app = build(width,display_width=display_width)
+    run_frames(source,s,app,Timings(maxlen=None),warmup)
+
+    timings = Timings(maxlen=None)
+    run_frames(source,s,app,timings,frames)
+
+    #second, shorter pass for allocations as tracemalloc slows everything down
+    allocations = Allocations(maxlen=None)
+    tracemalloc.start()
+    try:
+        run_frames(source,s,app,allocations,max(1,frames//10))
+    finally:
+        tracemalloc.stop()
+
+    stages = {}
+    for name,samples in timings.samples.items():
+        stages[name] = summarize(samples)
+        stages[name]['alloc_bytes'] = int(np.median(allocations.samples[name]))
+    #stages that were skipped (e.g. filter while holding peaks) count as zero
+    per_frame = np.zeros(frames)
+    alloc = np.zeros(len(allocations.samples['preview']))
+    for name in PIPELINE:
+        if not timings.samples[name]:
+            continue #never ran, e.g. average and correction while they are off
+        per_frame[-len(timings.samples[name]):] += timings.samples[name]
+        alloc[-len(allocations.samples[name]):] += allocations.samples[name]
+    total = summarize(per_frame)
+    total['alloc_bytes'] = int(np.median(alloc))
+    return {'width': width, 'display_width': app.display.width, 'stages': stages, 'total': total, 'text_cache': ui.text_cache.stats}
+
+
+def report(result, out=sys.stdout):
+    print(f"\nwidth={result['width']} display_width={result['display_width']}",file=out)
+    print(f"{'stage':<18}{'fps':>10}{'p50 ms':>10}{'p99 ms':>10}{'alloc kB':>10}",file=out)
+    rows = list(result['stages'].items()) + [('total',result['total'])]
+    for name,stats in rows:
+        print(f"{name:<18}{stats['fps']:>10.0f}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['alloc_bytes']/1024:>10.1f}",file=out)
+
+
+def run(widths=WIDTHS, frames=300, warmup=30, output=None, display_width=None):
+    """
+    Drive the per-frame pipeline from synthetic frames with no GUI and
+    report per stage and total throughput, latency and allocations for
+    each sensor width, drawn display_width wide if given. Results are
+    written to output as JSON.
+    """
+    results = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'frames': frames,
+        'display_width': display_width,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'results': [],
+    }
+    for width in widths:
+        result = bench_width(width,frames,warmup,display_width)
+        report(result)
+        results['results'].append(result)
+
+    if output is None:
+        output = "bench-" + time.strftime("%Y%m%d--%H%M%S") + ".json"
+    with open(output,'w') as f:
+        json.dump(results,f,indent=2)
+    print(f"\nResults written to {output}")
+    return results
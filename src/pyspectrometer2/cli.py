@@ -2,13 +2,36 @@ import argparse
 
 def args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--device", default="0", help="Video Device number e.g. 0, use v4l2-ctl --list-devices")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--device", default="0", help="Video Device number e.g. 0, use v4l2-ctl --list-devices")
+    source.add_argument("--video", help="Replay a recorded video file instead of a camera")
+    source.add_argument("--images", help="Replay a directory of PNG frames instead of a camera")
+    source.add_argument("--synthetic", action="store_true", help="Generate frames of a synthetic emission spectrum instead of using a camera")
+    parser.add_argument("--lines", help="Emission lines for --synthetic in nm e.g. 436.6,546.5,611.6")
+    parser.add_argument("--realtime", action="store_true", help="Replay --video/--images/--synthetic at their frame rate instead of as fast as possible")
     parser.add_argument("--fps", type=int, default=30, help="Frame Rate e.g. 30")
+    parser.add_argument("--display-rate", type=float, help="Redraw the windows at most this many times a second e.g. 15, every frame is still processed (default: redraw every frame)")
+    parser.add_argument("--display-width", type=int, help="Draw the windows this many pixels wide e.g. 800, the spectrum is still processed at the full --width (default: the sensor width)")
     parser.add_argument("--flip", action='store_true', help="Mirror video")
     parser.add_argument("--width", type=int, default = 800)
     parser.add_argument("--height", type=int, default = 600)
+    parser.add_argument("--sample-rows", type=int, default=3, help="Rows of the preview averaged into the spectrum e.g. 3")
+    parser.add_argument("--channel", choices=["luma","max","blue","green","red"], default="luma", help="How the colour channels of the sampled rows are combined into intensity")
+    parser.add_argument("--cal-order", type=int, help="Polynomial order of the wavelength calibration (default 2nd for 3 points, 3rd for more)")
+    parser.add_argument("--peak-fit", choices=["parabolic","gaussian","centroid"], default="parabolic", help="How peaks are refined to sub-pixel positions")
+    parser.add_argument("--reader", choices=["latest","all"], help="Read frames on a background thread, keeping only the latest frame or queueing all of them")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--fullscreen", help="Fullscreen (Native 800*480)",action="store_true")
     group.add_argument("--waterfall", help="Enable Waterfall (Windowed only)",action="store_true")
+    group.add_argument("--headless", help="No windows, stream spectra and peaks as JSON lines",action="store_true")
+    parser.add_argument("--output", help="File for --headless output (default: stdout)")
+    parser.add_argument("--record", help="Append every spectrum to this archive file from the start (toggle with 'r' in the GUI)")
+    parser.add_argument("--compress", action="store_true", help="zlib compress recorded archives")
+    commands = parser.add_subparsers(dest="command")
+    bench = commands.add_parser("bench", help="Benchmark the per-frame pipeline on synthetic frames, no GUI")
+    bench.add_argument("--widths", default="640,800,1280,1920", help="Sensor widths to benchmark e.g. 640,800,1280,1920")
+    bench.add_argument("--display-width", type=int, help="Draw the windows this wide at every sensor width e.g. 800 (default: the sensor width)")
+    bench.add_argument("--frames", type=int, default=300, help="Frames timed per width e.g. 300")
+    bench.add_argument("--output", help="JSON results file (default: bench-<date>.json)")
     args = parser.parse_args()
     return args
@@ -0,0 +1,176 @@
+from pathlib import Path
+from warnings import warn
+
+import numpy as np
+
+
+class Correction():
+    """
+    Dark frame, flat field and hot pixel correction of the sampled spectrum.
+
+    The dark and flat (reference) spectra are averages over a number of
+    frames, saved as float32 vectors next to caldata.txt so they survive a
+    restart. Hot pixels are found from the dark spectrum and replaced by the
+    mean of their nearest good neighbours.
+
+    output chooses what apply() returns, always scaled to the 0-255 range
+    the graph expects:
+        intensity      raw - dark
+        flat           (raw - dark) flat fielded, scaled back to the reference mean
+        transmittance  (raw - dark) / (flat - dark), 1.0 = 255
+        absorbance     -log10(transmittance), 1 AU = 100
+    """
+    outputs = ('intensity','flat','transmittance','absorbance')
+    short = {'intensity': '', 'flat': ' FF', 'transmittance': ' T', 'absorbance': ' A'}
+    files = {'dark': 'darkdata.npy', 'flat': 'flatdata.npy'}
+
+    hot_sigma = 5 #how far above the dark's median a pixel is hot, in robust standard deviations
+    hot_minimum = 4 #and by at least this many counts, so a perfectly quiet sensor has no hot pixels
+
+    def __init__(self, width, output='intensity', directory='.'):
+        if output not in self.outputs:
+            raise ValueError(f"Unknown correction output {output!r}, expected one of {self.outputs}")
+        self.width = width
+        self.output = output
+        self.directory = Path(directory) #where the dark and flat are saved, next to the calibration
+        self.dark = None
+        self.flat = None
+        self.hot = np.array([],dtype=int) #hot pixel indexes, and their nearest good neighbours
+        self.hot_left = self.hot
+        self.hot_right = self.hot
+        self.capturing = None #'dark' or 'flat' while averaging frames for it
+        self.out = np.zeros(width,dtype=np.float32)
+        self.prepare()
+
+    @property
+    def active(self):
+        return self.dark is not None or self.flat is not None or self.capturing is not None
+
+    def path(self, kind):
+        return self.directory / self.files[kind]
+
+    def load(self):
+        for kind in self.files:
+            filename = self.path(kind)
+            try:
+                data = np.load(filename)
+            except FileNotFoundError:
+                continue
+            if data.shape != (self.width,):
+                warn(f"Ignoring {filename}, it is for {len(data)} pixels not {self.width}")
+                continue
+            setattr(self,kind,data.astype(np.float32))
+        self.prepare()
+
+    def save(self, kind):
+        np.save(self.path(kind),getattr(self,kind))
+
+    def start_capture(self, kind, frames):
+        "average the next frames raw spectra into the dark or flat spectrum"
+        if kind not in self.files:
+            raise ValueError(f"Unknown correction spectrum {kind!r}")
+        self.capturing = kind
+        self.capture_frames = frames
+        self.captured = 0
+        self.capture_total = np.zeros(self.width) #float64, as it may run for many frames
+
+    def feed(self, raw):
+        #returns True once the capture is complete
+        if self.capturing is None:
+            return False
+        self.capture_total += raw
+        self.captured += 1
+        if self.captured < self.capture_frames:
+            return False
+        kind = self.capturing
+        setattr(self,kind,(self.capture_total / self.captured).astype(np.float32))
+        self.capturing = None
+        self.capture_total = None
+        self.save(kind)
+        self.prepare()
+        return True
+
+    def find_hot_pixels(self):
+        if self.dark is None:
+            return np.array([],dtype=int)
+        median = np.median(self.dark)
+        sigma = 1.4826 * np.median(np.abs(self.dark - median))
+        return np.flatnonzero(self.dark > median + max(self.hot_sigma*sigma,self.hot_minimum))
+
+    def prepare(self):
+        #everything per frame work needs, so apply() is one pass
+        self.offset = self.dark if self.dark is not None else np.zeros(self.width,dtype=np.float32)
+
+        self.hot = self.find_hot_pixels()
+        good = np.ones(self.width,dtype=bool)
+        good[self.hot] = False
+        if len(self.hot) and good.any():
+            #nearest good pixel to the left and right of every pixel, falling back to the other side at the ends
+            index = np.arange(self.width)
+            left = np.maximum.accumulate(np.where(good,index,-1))
+            right = np.minimum.accumulate(np.where(good,index,self.width)[::-1])[::-1]
+            left = np.where(left < 0,right,left)
+            right = np.where(right >= self.width,left,right)
+            self.hot_left = left[self.hot]
+            self.hot_right = right[self.hot]
+        else:
+            self.hot = self.hot_left = self.hot_right = np.array([],dtype=int)
+
+        if self.flat is None:
+            self.gain = None
+            return
+        reference = self.flat - self.offset
+        #columns the reference never lit can't be corrected, leave them dark
+        valid = reference > 1
+        reference = np.where(valid,reference,1)
+        self.gain = np.where(valid,1/reference,0).astype(np.float32)
+        self.reference_mean = float(reference[valid].mean()) if valid.any() else 1.0
+
+    def cycle_output(self):
+        #the flat based outputs only make sense once there is a flat
+        outputs = self.outputs if self.flat is not None else self.outputs[:1]
+        index = outputs.index(self.output) if self.output in outputs else -1
+        self.output = outputs[(index + 1) % len(outputs)]
+
+    def apply(self, raw):
+        "the corrected spectrum, a float32 array reused every call"
+        out = self.out
+        np.subtract(raw,self.offset,out=out,casting='unsafe')
+        output = self.output if self.gain is not None else 'intensity'
+        if output != 'intensity':
+            out *= self.gain
+            if output == 'flat':
+                out *= self.reference_mean
+            elif output == 'transmittance':
+                out *= 255
+            else:
+                np.maximum(out,1e-4,out=out)
+                np.log10(out,out=out)
+                out *= -100
+        if len(self.hot):
+            out[self.hot] = (out[self.hot_left] + out[self.hot_right]) / 2
+        np.clip(out,0,255,out=out)
+        return out
+
+    @property
+    def label(self):
+        if self.capturing is not None:
+            return f"{self.capturing.title()} {self.captured}/{self.capture_frames}"
+        parts = [kind.title() for kind in self.files if getattr(self,kind) is not None]
+        if not parts:
+            return "No dark/flat"
+        label = '+'.join(parts)
+        if len(self.hot):
+            label += f" {len(self.hot)}hot"
+        if self.gain is not None:
+            label += self.short[self.output]
+        return label
+
+    @property
+    def settings(self):
+        return {
+            'dark': self.dark is not None,
+            'flat': self.flat is not None,
+            'output': self.output,
+            'hot_pixels': self.hot.tolist(),
+        }
@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+from .record import Calibration
+from .specFunctions import wavelengths_to_bgr
+
+
+class DisplayAxis():
+    """
+    Maps the sensor's pixel columns onto the (narrower) columns of the
+    windows, so a high resolution sensor is still processed at full
+    resolution but drawn at e.g. 800px.
+
+    Display columns are evenly spaced in wavelength where the calibration
+    allows it, otherwise evenly spaced in pixels. Each one covers a run of
+    sensor pixels. The runs are worked out once per calibration, so
+    reducing a spectrum to the display is a single np.ufunc.reduceat per
+    min, max or mean. The max keeps narrow peaks that a plain resample
+    would step over.
+
+    It has the wavelengthData, colorData and ticks() of a Calibration, in
+    display columns, so the graticule and cursor are drawn from it as if it
+    were one. Its wavelengths come from the full resolution calibration.
+    """
+
+    def __init__(self, calibration: Calibration, width=None):
+        self.calibration = calibration
+        sensor_width = calibration.width
+        #never wider than the sensor, there is nothing to gain from upsampling
+        self.width = min(width or sensor_width,sensor_width)
+        self.identity = self.width == sensor_width
+
+        if self.identity:
+            self.starts = np.arange(sensor_width)
+            self.columns = np.arange(sensor_width,dtype=float)
+        else:
+            if calibration.monotonic:
+                #evenly spaced wavelengths, left to right in the same direction as the sensor
+                nm = calibration.wavelengthData
+                edges = calibration.pixel(np.linspace(nm[0],nm[-1],self.width+1))
+            else:
+                edges = np.linspace(0,sensor_width-1,self.width+1)
+            #first sensor pixel of every display column, the last one runs to the end of the sensor.
+            #a column narrower than a pixel repeats its neighbour's start, reduceat then takes that one pixel
+            self.starts = np.minimum(np.floor(edges[:-1]),sensor_width-1).astype(np.intp)
+            self.starts[0] = 0
+            #fractional sensor pixel at the middle of every display column
+            self.columns = (edges[:-1] + edges[1:]) / 2
+        self.counts = np.maximum(np.diff(self.starts,append=sensor_width),1)
+
+        self.wavelengthData = calibration.wavelength(self.columns)
+        self.colorData = wavelengths_to_bgr(self.wavelengthData)
+        self.low = np.zeros(self.width,dtype=np.int64)
+        self.high = np.zeros(self.width,dtype=np.int64)
+        self.mean = np.zeros(self.width,dtype=np.int64)
+        self.maps = {} #remap tables for resample(), per image height
+
+    def ticks(self, step):
+        "(wavelength, display column) of every whole multiple of step nm on the sensor"
+        calibration = self.calibration
+        multiples = calibration.whole_nm % step == 0
+        pixels = calibration.whole_nm_pixels[multiples]
+        columns = np.rint(np.interp(pixels,self.columns,np.arange(self.width))).astype(int)
+        return list(zip(calibration.whole_nm[multiples].astype(int).tolist(),columns.tolist()))
+
+    def column(self, pixel):
+        "display column each sensor pixel is drawn in"
+        if self.identity:
+            return pixel
+        return np.searchsorted(self.starts,pixel,side='right') - 1
+
+    def pixel(self, column):
+        "sensor pixel at the middle of each display column"
+        if self.identity:
+            return column
+        return np.rint(self.columns[column]).astype(int)
+
+    def resample(self, image):
+        "image (e.g. the preview) resampled to the display columns, so it lines up with the graph"
+        if self.identity:
+            return image
+        height = len(image)
+        if height not in self.maps:
+            x = np.broadcast_to(self.columns.astype(np.float32),(height,self.width))
+            y = np.broadcast_to(np.arange(height,dtype=np.float32)[:,None],(height,self.width))
+            #fixed point tables remap about twice as fast
+            self.maps[height] = cv2.convertMaps(x,y,cv2.CV_16SC2)
+        return cv2.remap(image,*self.maps[height],cv2.INTER_LINEAR)
+
+    def maximum(self, values):
+        "highest value in every display column, a reused array (or values itself at full width)"
+        if self.identity:
+            return values
+        return np.maximum.reduceat(np.asarray(values,dtype=np.int64),self.starts,out=self.high)
+
+    def reduce(self, values):
+        "(lowest, highest, mean) value in every display column, reused integer arrays"
+        if self.identity:
+            return values, values, values
+        values = np.asarray(values,dtype=np.int64) #held peaks are still uint8
+        np.minimum.reduceat(values,self.starts,out=self.low)
+        np.maximum.reduceat(values,self.starts,out=self.high)
+        np.add.reduceat(values,self.starts,out=self.mean)
+        #rounded mean
+        self.mean += self.counts // 2
+        self.mean //= self.counts
+        return self.low, self.high, self.mean
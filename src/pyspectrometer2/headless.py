@@ -0,0 +1,56 @@
+import json
+import sys
+
+import cv2
+
+from .spectrometer import Spectrometer
+from .video import FrameSource
+
+
+def spectrum_record(s: Spectrometer, timestamp):
+    "one processed frame as a JSON friendly dict"
+    peaks = [{
+        'pixel': int(x),
+        'position': float(position), #sub-pixel
+        'wavelength': float(wavelength),
+        'intensity': int(s.intensity[x]),
+        'height': float(height),
+    } for x,position,wavelength,height in zip(s.peaks,s.peak_positions,s.peak_wavelengths,s.peak_heights)]
+    return {
+        'timestamp': timestamp,
+        'intensity': s.intensity.tolist(),
+        'peaks': peaks,
+    }
+
+
+def run(s: Spectrometer, capture: FrameSource, output=sys.stdout, flip=False):
+    """
+    Capture -> sample -> smooth -> peak detect with no windows and no drawing.
+    Writes JSON lines to output: a header with the wavelength of every pixel
+    column, then one record per frame.
+    """
+    header = {
+        'calibration': s.calibration.status(),
+        'r_squared': s.calibration.r_squared,
+        'residuals': s.calibration.residuals.tolist(),
+        'wavelengths': list(map(float,s.calibration.wavelengthData)),
+    }
+    output.write(json.dumps(header)+'\n')
+    try:
+        while capture.isOpened():
+            success, frame = capture.read()
+            if not success:
+                break
+            if flip:
+                FLIP_ABOUT_Y_AXIS = 1
+                frame = cv2.flip(frame,flipCode=FLIP_ABOUT_Y_AXIS)
+            timestamp = capture.frame.timestamp
+            s.process(capture.cropped_preview(frame),timestamp)
+            record = spectrum_record(s,timestamp)
+            output.write(json.dumps(record)+'\n')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.flush()
+        s.stop_recording()
+        capture.release()
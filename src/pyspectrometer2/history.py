@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class History():
+    "fixed size ring of rows, read back newest first"
+
+    def __init__(self, depth, shape, dtype=np.uint8):
+        self.rows = np.zeros([depth,*shape],dtype=dtype)
+        self.index = 0 #slot holding the newest row
+        self.count = 0 #rows pushed so far, up to depth
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def depth(self):
+        return len(self.rows)
+
+    @property
+    def full(self):
+        return self.count == self.depth
+
+    @property
+    def oldest(self):
+        #the row the next push will overwrite
+        return self.rows[(self.index - 1) % self.depth]
+
+    def push(self, row):
+        #the write index walks backwards so that rows[index:] + rows[:index]
+        #is already newest first, no reversing needed when reading back
+        self.index = (self.index - 1) % self.depth
+        self.rows[self.index] = row
+        self.count = min(self.count + 1, self.depth)
+
+    def latest(self, n=None, out=None):
+        "copy the newest n rows (default all) into out, newest first"
+        n = self.depth if n is None else min(n,self.depth)
+        if out is None:
+            out = np.empty([n,*self.rows.shape[1:]],dtype=self.rows.dtype)
+        head = self.rows[self.index:self.index+n]
+        out[:len(head)] = head
+        out[len(head):n] = self.rows[:n-len(head)]
+        return out
+
+
+class Average():
+    """
+    Average of the last n spectra, either a boxcar over a ring of the last n
+    or an exponential moving average with alpha = 2/(n+1). Both keep running
+    state, so a frame costs the same whatever n is.
+    """
+    modes = ('off','boxcar','ema')
+
+    def __init__(self, width, n=16, mode='off'):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown averaging mode {mode!r}, expected one of {self.modes}")
+        self.width = width
+        self.mode = mode
+        self.n = n
+        self.out = np.zeros(width,dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        #start again from the next frame, e.g. after n or the mode changes
+        self.history = History(self.n,[self.width],dtype=np.float32)
+        self.total = np.zeros(self.width) #float64 so subtracting the oldest row never drifts
+        self.ema = None
+
+    def set_n(self, n):
+        if n != self.n:
+            self.n = n
+            self.reset()
+
+    def set_mode(self, mode):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown averaging mode {mode!r}, expected one of {self.modes}")
+        if mode != self.mode:
+            self.mode = mode
+            self.reset()
+
+    def __len__(self):
+        "frames in the current average"
+        if self.mode == 'ema':
+            return 0 if self.ema is None else self.n
+        return len(self.history)
+
+    def update(self, spectrum):
+        "add a spectrum and return the average so far, a float32 array reused every call"
+        if self.mode == 'boxcar':
+            if self.history.full:
+                self.total -= self.history.oldest
+            self.history.push(spectrum)
+            self.total += self.history.rows[self.history.index]
+            np.divide(self.total,len(self.history),out=self.out,casting='unsafe')
+        elif self.mode == 'ema':
+            if self.ema is None:
+                self.ema = np.array(spectrum,dtype=np.float32)
+            else:
+                #ema += alpha * (spectrum - ema), in place
+                np.subtract(spectrum,self.ema,out=self.out,casting='unsafe')
+                self.out *= 2 / (self.n + 1)
+                self.ema += self.out
+            self.out[:] = self.ema
+        else:
+            self.out[:] = spectrum
+        return self.out
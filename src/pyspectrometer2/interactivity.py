@@ -2,9 +2,10 @@ from dataclasses import dataclass
 from warnings import warn
 
 from .record import Calibration
-from . import record
 from .ui import Overlay
-from .video import Capture
+from .video import FrameSource
+
+MAX_AVERAGE = 1024 #most frames the averaging can span
 
 class SpectrometerInteractivity:
 
@@ -23,6 +24,22 @@ class SpectrometerInteractivity:
             self.app.capture.adjust_crop_offset(1)
         elif keyPress == ord('h'):
             self.app.holdpeaks = not self.app.holdpeaks
+        elif keyPress == ord('a'):
+            #cycle temporal averaging off -> boxcar -> ema
+            self.app.s.cycle_average_mode()
+        elif keyPress in (ord('+'),ord('=')):#average more frames
+            self.app.s.average_n = min(self.app.s.average_n*2,MAX_AVERAGE)
+        elif keyPress == ord('-'):#average fewer frames
+            self.app.s.average_n = max(self.app.s.average_n//2,2)
+        elif keyPress == ord('d'):
+            #average the next N frames into the dark spectrum, cover the slit first!
+            self.app.s.capture_correction('dark')
+        elif keyPress == ord('f'):
+            #average the next N frames into the flat/reference spectrum, light source on, no sample
+            self.app.s.capture_correction('flat')
+        elif keyPress == ord('v'):
+            #cycle intensity -> flat field -> transmittance -> absorbance
+            self.app.s.correction.cycle_output()
         elif keyPress == ord("s"):
             #package up the data!
             graphdata = []
@@ -31,14 +48,30 @@ class SpectrometerInteractivity:
             savedata = [ self.app.s.spectrum_vertical, graphdata]
             if self.app.waterfall:
                 savedata.append(self.app.s.waterfall_vertical)
-            self.app.saveMsg = record.snapshot(savedata,waterfall=self.app.waterfall)
+            if self.app.snapshots.submit(savedata,waterfall=self.app.waterfall):
+                self.app.saveMsg = "Saving..."
+            else:
+                self.app.saveMsg = "Save queue full!"
+        elif keyPress == ord("r"):
+            #toggle recording every spectrum to an archive
+            if self.app.s.recorder is None:
+                filename = self.app.s.start_recording(compression=self.app.record_compression)
+                self.app.saveMsg = "Recording: "+filename
+            else:
+                count = self.app.s.stop_recording()
+                self.app.saveMsg = f"Recorded {count} spectra"
+        elif keyPress == ord("e"):
+            #export the per stage timings
+            filename = self.app.s.timings.dump()
+            self.app.saveMsg = "Metrics: "+filename
         elif keyPress == ord("c"):
-            clickArray = [(c.x,c.y) for c in self.app.overlay.clicks]
+            #clicks are in display columns, the calibration is in sensor pixels
+            clickArray = [(int(self.app.display.pixel(c.x)),c.y) for c in self.app.overlay.clicks]
             calcomplete = self.app.s.calibration.writecal(clickArray)
             if calcomplete:
                 #overwrite wavelength data
                 #Go grab the computed calibration data
-                self.app.s.calibration = Calibration(self.app.capture.width)
+                self.app.s.calibration = Calibration(self.app.capture.width,order=self.app.s.calibration.order)
                 self.app.overlay.clear_claibration_clicks()
         elif keyPress == ord("x"):
             self.app.overlay.clear_claibration_clicks()
@@ -0,0 +1,97 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+import numpy as np
+
+#histogram bins for dumped stats, 10us to 1s
+HISTOGRAM_EDGES_MS = np.logspace(-2,3,26)
+
+
+class Timings():
+    """
+    How long each stage of the frame pipeline took, the last maxlen frames
+    per stage, plus a running total per stage so the rolling mean is cheap
+    enough to show on every frame. Render threads add their stages from
+    their own threads, so changes are made under a lock.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.samples = defaultdict(lambda: deque(maxlen=self.maxlen))
+        self.totals = defaultdict(float)
+        self.frames = deque(maxlen=self.maxlen) #perf_counter() at the end of every frame
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name,time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            samples = self.samples[name]
+            if len(samples) == samples.maxlen:
+                self.totals[name] -= samples[0]
+            samples.append(seconds)
+            self.totals[name] += seconds
+
+    def tick(self):
+        "mark the end of a frame"
+        self.frames.append(time.perf_counter())
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+            self.frames.clear()
+
+    @property
+    def fps(self):
+        "frames actually processed per second, over the rolling window"
+        if len(self.frames) < 2:
+            return 0.0
+        return (len(self.frames) - 1) / (self.frames[-1] - self.frames[0])
+
+    def mean(self, name):
+        samples = self.samples[name]
+        return self.totals[name] / len(samples) if samples else 0.0
+
+    @property
+    def slowest(self):
+        "the stage with the highest rolling mean"
+        with self.lock:
+            if not self.samples:
+                return None
+            return max(self.samples,key=self.mean)
+
+    def summary(self):
+        with self.lock:
+            samples = {name:list(samples) for name,samples in self.samples.items()}
+        stages = {}
+        for name,samples in samples.items():
+            ms = np.asarray(samples,dtype=float) * 1000
+            counts, _ = np.histogram(ms,bins=HISTOGRAM_EDGES_MS)
+            stages[name] = {
+                'count': len(ms),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms,50)),
+                'p99_ms': float(np.percentile(ms,99)),
+                'max_ms': float(ms.max()),
+                'histogram': {'edges_ms': HISTOGRAM_EDGES_MS.tolist(), 'counts': counts.tolist()},
+            }
+        return {'fps': self.fps, 'slowest': self.slowest, 'stages': stages}
+
+    def dump(self, filename=None):
+        if filename is None:
+            filename = "metrics-" + time.strftime("%Y%m%d--%H%M%S") + ".json"
+        summary = self.summary()
+        summary['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(filename,'w') as f:
+            json.dump(summary,f,indent=2)
+        return filename
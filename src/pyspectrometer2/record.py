@@ -1,108 +1,214 @@
 from dataclasses import dataclass
+from pathlib import Path
 from warnings import warn
 import cv2
+import hashlib
+import queue
+import threading
 import time
 
 import numpy as np
 
 from .exceptions import CalibrationError
+from .specFunctions import wavelengths_to_bgr
 
-def snapshot(savedata,waterfall=False):
-    now = time.strftime("%Y%m%d--%H%M%S")
-    timenow = time.strftime("%H:%M:%S")
+def snapshot(savedata,waterfall=False,now=None,suffix=""):
+    #now is the time the save was asked for, it defaults to the current time.
+    #suffix tells apart saves made within the same second
+    now = now or time.localtime()
+    timenow = time.strftime("%H:%M:%S",now)
+    stamp = time.strftime("%Y%m%d--%H%M%S",now) + suffix
     imdata1 = savedata[0]
     graphdata = savedata[1]
     if waterfall:
         imdata2 = savedata[2]
-        cv2.imwrite("waterfall-" + now + ".png",imdata2)
-    cv2.imwrite("spectrum-" + now + ".png",imdata1)
-    #print(graphdata[0]) #wavelengths
-    #print(graphdata[1]) #intensities
-    f = open("Spectrum-"+now+'.csv','w')
-    f.write('Wavelength,Intensity\r\n')
-    for x in zip(graphdata[0],graphdata[1]):
-        f.write(str(x[0])+','+str(x[1])+'\r\n')
-    f.close()
+        cv2.imwrite("waterfall-" + stamp + ".png",imdata2)
+    cv2.imwrite("spectrum-" + stamp + ".png",imdata1)
+    #format the whole CSV in one go, one write
+    rows = [f"{wavelength},{intensity}" for wavelength,intensity in zip(list(graphdata[0]),np.asarray(graphdata[1]).tolist())]
+    with open("Spectrum-"+stamp+'.csv','w',newline='') as f:
+        f.write('Wavelength,Intensity\r\n' + '\r\n'.join(rows) + '\r\n')
     message = "Last Save: "+timenow
     return(message)
 
+class SnapshotWriter():
+    """
+    Saves snapshots on a background thread so PNG encoding and writing to
+    (slow) storage never holds up acquisition. Jobs carry their own copies of
+    the images and data. When the queue is full submit() refuses the job
+    rather than blocking the main loop.
+    """
+
+    def __init__(self, maxsize=4):
+        self.jobs = queue.Queue(maxsize)
+        self.messages = queue.SimpleQueue()
+        self.last_stamp = None
+        self.repeats = 0
+        self.thread = threading.Thread(target=self.run,name='SnapshotWriter',daemon=True)
+        self.thread.start()
+
+    def submit(self,savedata,waterfall=False):
+        "queue a snapshot, False if the writer is too far behind"
+        images = [np.array(savedata[0])]
+        if waterfall:
+            images.append(np.array(savedata[2]))
+        graphdata = [np.array(savedata[1][0]),np.array(savedata[1][1])]
+        now = time.localtime()
+        stamp = time.strftime("%Y%m%d--%H%M%S",now)
+        self.repeats = self.repeats + 1 if stamp == self.last_stamp else 0
+        self.last_stamp = stamp
+        suffix = f"-{self.repeats+1}" if self.repeats else ""
+        job = ([images[0],graphdata,*images[1:]],waterfall,now,suffix)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self.messages.put(snapshot(*job))
+            except Exception as e:
+                self.messages.put(f"Save failed: {e}")
+
+    def poll(self):
+        "the most recent completion message since the last poll, or None"
+        message = None
+        while not self.messages.empty():
+            message = self.messages.get()
+        return message
+
+    def close(self):
+        #finish the queued saves
+        self.jobs.put(None)
+        self.thread.join()
+
+def ordinal(n):
+    suffixes = {1:'st',2:'nd',3:'rd'}
+    return str(n) + suffixes.get(n if n < 20 else n % 10,'th')
+
 @dataclass
 class Calibration():
     width: int
     pixels: list[int] = None
     wavelengths: list[int] = None
+    order: int = None #polynomial order, by default 2nd for 3 points and 3rd for more
+    filename: str = 'caldata.txt'
 
     def __post_init__(self):
         self.wavelengthData = []
-        self.readcal()
-        self.map_px_wavelength()
+        self.residuals = np.array([]) #nm, measured - fitted at every calibration point
+        self.r_squared = None
+        self.key = None #identifies the calibration file, width and order for the cache
+        if self.pixels is None:
+            self.readcal(self.filename)
+        if not self.load_cache():
+            self.map_px_wavelength()
+            self.save_cache()
+        self.index_wavelengths()
+
+    @property
+    def fit_order(self):
+        if self.order is not None:
+            return self.order
+        return 2 if len(self.pixels) == 3 else 3
 
     def status(self):
         if not self.pixels:
             return "UNCALIBRATED"
-        if len(self.pixels) == 3:
-            return "Calibrated 2nd Order"
-        return "Calibrated 3rd Order"
+        return f"Cal {ordinal(self.fit_order)} order R2={self.r_squared:.5f}"
 
     def map_px_wavelength(self):
-        #create an array for the data...
-        
-        if (len(self.pixels) == 3):
-            print("Calculating second order polynomial...")
-            coefficients = np.poly1d(np.polyfit(self.pixels, self.wavelengths, 2))
-            print(coefficients)
-            C1 = coefficients[2]
-            C2 = coefficients[1]
-            C3 = coefficients[0]
-            print("Generating Wavelength Data!\n\n")
-            for pixel in range(self.width):
-                wavelength=((C1*pixel**2)+(C2*pixel)+C3)
-                wavelength = round(wavelength,6) #because seriously!
-                self.wavelengthData.append(wavelength)
-            print("Done! Note that calibration with only 3 wavelengths will not be accurate!")
+        #fit the calibration points, then evaluate the polynomial for every pixel column
+        order = self.fit_order
+        if len(self.pixels) <= order:
+            raise CalibrationError(f"A {ordinal(order)} order calibration needs more than {order} points, got {len(self.pixels)}")
+        if len(self.pixels) == 3:
             warn("Note that calibration with only 3 wavelengths will not be accurate!")
+        coefficients = np.polyfit(self.pixels, self.wavelengths, order)
+        self.wavelengthData = np.round(np.polyval(coefficients, np.arange(self.width)), 6) #because seriously!
 
-        if (len(self.pixels) > 3):
-            print("Calculating third order polynomial...")
-            coefficients = np.poly1d(np.polyfit(self.pixels, self.wavelengths, 3))
-            print(coefficients)
-            #note this pulls out extremely precise numbers.
-            #this causes slight differences in vals then when we compute manual, but hey ho, more precision
-            #that said, we waste that precision later, but tbh, we wouldn't get that kind of precision in
-            #the real world anyway! 1/10 of a nm is more than adequate!
-            C1 = coefficients[3]
-            C2 = coefficients[2]
-            C3 = coefficients[1]
-            C4 = coefficients[0]
-            '''
-            print(C1)
-            print(C2)
-            print(C3)
-            print(C4)
-            '''
-            print("Generating Wavelength Data!\n\n")
-            for pixel in range(self.width):
-                wavelength=((C1*pixel**3)+(C2*pixel**2)+(C3*pixel)+C4)
-                wavelength = round(wavelength,6)
-                self.wavelengthData.append(wavelength)
-
-            #final job, we need to compare all the recorded wavelenths with predicted wavelengths
-            #and note the deviation!
-            #do something if it is too big!
-            predicted = []
-            #iterate over the original pixelnumber array and predict results
-            for i in self.pixels:
-                px = i
-                y=((C1*px**3)+(C2*px**2)+(C3*px)+C4)
-                predicted.append(y)
-
-            #calculate 2 squared of the result
-            #if this is close to 1 we are all good!
-            corr_matrix = np.corrcoef(self.wavelengths, predicted)
-            corr = corr_matrix[0,1]
-            R_sq = corr**2
-
-            print("R-Squared="+str(R_sq))
+        #compare the recorded wavelengths with the fitted ones, R2 close to 1 is good
+        measured = np.asarray(self.wavelengths, dtype=float)
+        self.residuals = measured - np.polyval(coefficients, self.pixels)
+        total = np.sum((measured - measured.mean())**2)
+        self.r_squared = 1 - np.sum(self.residuals**2)/total if total else 1.0
+
+        #colour of every pixel column, used when drawing the graph and waterfall
+        self.colorData = wavelengths_to_bgr(self.wavelengthData)
+
+    def index_wavelengths(self):
+        #inverse of wavelengthData, only possible if the wavelengths always rise (or always fall) across the sensor
+        self.columns = np.arange(self.width,dtype=float)
+        steps = np.diff(self.wavelengthData)
+        self.increasing = bool(np.all(steps > 0))
+        self.monotonic = self.increasing or bool(np.all(steps < 0))
+        if not self.monotonic:
+            warn("Calibration wavelengths are not monotonic, wavelength to pixel lookups are unavailable")
+            self.whole_nm = self.whole_nm_pixels = np.array([])
+            return
+        if self.increasing:
+            self.sorted_nm, self.sorted_columns = self.wavelengthData, self.columns
+        else:
+            self.sorted_nm, self.sorted_columns = self.wavelengthData[::-1], self.columns[::-1]
+        #pixel position of every whole nm on the sensor
+        self.whole_nm = np.arange(np.ceil(self.sorted_nm[0]),np.floor(self.sorted_nm[-1])+1)
+        self.whole_nm_pixels = self.pixel(self.whole_nm)
+
+    def pixel(self, nm):
+        "fractional pixel column of each wavelength, nan off the sensor"
+        if not self.monotonic:
+            raise CalibrationError("Calibration wavelengths are not monotonic")
+        #np.interp binary searches the sorted wavelengths, O(log n) per lookup
+        return np.interp(nm,self.sorted_nm,self.sorted_columns,left=np.nan,right=np.nan)
+
+    def wavelength(self, pixel):
+        "wavelength at each fractional pixel column, nan off the sensor"
+        return np.interp(pixel,self.columns,self.wavelengthData,left=np.nan,right=np.nan)
+
+    def ticks(self, step):
+        "(wavelength, pixel column) of every whole multiple of step nm on the sensor"
+        multiples = self.whole_nm % step == 0
+        columns = np.rint(self.whole_nm_pixels[multiples]).astype(int)
+        return list(zip(self.whole_nm[multiples].astype(int).tolist(),columns.tolist()))
+
+    @property
+    def cache_filename(self):
+        return str(Path(self.filename).with_suffix('.cache.npz'))
+
+    def load_cache(self):
+        #reuse the last fit of this calibration file at this width and order
+        if self.key is None:
+            return False
+        try:
+            with np.load(self.cache_filename) as cache:
+                if str(cache['key']) != self.key:
+                    return False
+                wavelengthData = cache['wavelengths']
+                residuals = cache['residuals']
+                r_squared = float(cache['r_squared'])
+        except (OSError, KeyError, ValueError):
+            return False
+        if len(wavelengthData) != self.width:
+            return False
+        self.wavelengthData = wavelengthData
+        self.residuals = residuals
+        self.r_squared = r_squared
+        self.colorData = wavelengths_to_bgr(self.wavelengthData)
+        return True
+
+    def save_cache(self):
+        if self.key is None:
+            return
+        try:
+            np.savez(self.cache_filename, key=self.key, wavelengths=self.wavelengthData,
+                     residuals=self.residuals, r_squared=self.r_squared)
+        except OSError as e:
+            warn(f"Unable to write calibration cache {self.cache_filename}: {e}")
 
     def readcal(self,filename='caldata.txt'):
         #read in the calibration points
@@ -111,9 +217,11 @@ class Calibration():
 
         print("Loading calibration data...")
         try:
-            with open(filename, 'r') as file:
-                self.pixels = [int(i) for i in next(file).split(',')]
-                self.wavelengths = [float(f) for f in next(file).split(',')]
+            with open(filename, 'rb') as file:
+                contents = file.read()
+            lines = contents.decode().splitlines()
+            self.pixels = [int(i) for i in lines[0].split(',')]
+            self.wavelengths = [float(f) for f in lines[1].split(',')]
         except FileNotFoundError:
             warn(f"Missing {filename}. Using placeholder data.")
             self.pixels = [0,400,800]
@@ -124,6 +232,7 @@ class Calibration():
             raise CalibrationError(f"Invalid calbration {len(self.pixels)=} != {len(self.wavelengths)=}")
         if (len(self.pixels) < 3):
             raise CalibrationError(f"Invalid calbration {len(self.pixels)=} < 3")
+        self.key = f"{hashlib.sha256(contents).hexdigest()} width={self.width} order={self.fit_order}"
 
 
     def writecal(self,clickArray,filename="caldata.txt"):
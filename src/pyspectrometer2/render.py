@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+import threading
+
+import numpy as np
+
+from .display import DisplayAxis
+from .record import Calibration
+from .ui import Graticule
+
+
+def frozen(array):
+    #a read only copy, nothing can change it under a render thread
+    array = np.array(array)
+    array.flags.writeable = False
+    return array
+
+
+@dataclass(frozen=True)
+class Snapshot():
+    """
+    Everything one displayed frame is drawn from, copied off the processing
+    state so the next frame can be captured and processed while this one is
+    still being drawn.
+    """
+    preview: np.ndarray #display width
+    intensity: np.ndarray #per display column, the mean when decimating
+    low: np.ndarray #and the min and max, None at full width
+    high: np.ndarray
+    peaks: np.ndarray #display columns, the wavelengths are still refined at full resolution
+    peak_wavelengths: np.ndarray
+    sample_start: int
+    sample_stop: int
+    calibration: Calibration
+    display: DisplayAxis
+    graticule: Graticule #never redrawn, a new one is made when the calibration changes
+    labels: dict #overlay label slot -> message
+    measure: bool = False
+    recPixels: bool = False
+    cursor: tuple = (0,0)
+    clicks: tuple = () #(x,y) calibration clicks
+    waterfall: np.ndarray = None #newest history rows first, in a buffer reused once the renderer is done with it. None without the waterfall
+
+
+class Renderer():
+    """
+    Draws one window on a background thread, so drawing a frame overlaps
+    capturing and processing the next one. NumPy and OpenCV release the GIL
+    for the heavy lifting.
+
+    The window is double buffered: draw(snapshot, buffer) fills a back
+    buffer while the front one is on screen. submit() only keeps the newest
+    snapshot if the thread is behind. take() swaps a finished back buffer to
+    the front, the old front buffer is drawn into again only after that.
+    Only the caller touches the front buffer, so it can be shown (and saved)
+    without a copy.
+    """
+
+    def __init__(self, draw, buffers, name='Renderer'):
+        self.draw = draw
+        self.free = list(buffers)
+        self.front = None #buffer on screen
+        self.finished = None #back buffer drawn and waiting to be taken
+        self.pending = None #newest snapshot not yet drawn
+        self.drawing = None #snapshot being drawn right now
+        self.error = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run,name=name,daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (self.pending is None or not self.free):
+                    self.condition.wait()
+                if not self.running:
+                    break
+                snapshot, self.pending = self.pending, None
+                self.drawing = snapshot
+                buffer = self.free.pop()
+            try:
+                self.draw(snapshot,buffer)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.running = False
+                    self.condition.notify_all()
+                break
+            with self.condition:
+                self.drawing = None
+                if self.finished is not None:
+                    #never shown, a newer frame replaces it
+                    self.free.append(self.finished)
+                self.finished = buffer
+                self.condition.notify_all()
+
+    def withdraw(self):
+        "drop the snapshot waiting to be drawn, if any, and return the one being drawn (or None)"
+        with self.condition:
+            self.pending = None
+            return self.drawing
+
+    def take(self, wait=False):
+        "the newest finished buffer, now the front buffer. None if there is nothing new"
+        with self.condition:
+            while wait and self.running and self.finished is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise RuntimeError(f"{self.thread.name} failed") from self.error
+            if self.finished is None:
+                return None
+            if self.front is not None:
+                self.free.append(self.front)
+            self.front, self.finished = self.finished, None
+            self.condition.notify_all()
+            return self.front
+
+    def stop(self, timeout=1):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
@@ -26,6 +26,10 @@ It is planned to add in GPIO support, to allow the use of buttons and knobs to c
 '''
 
 
+from bisect import bisect_left, insort
+from functools import lru_cache
+from math import factorial
+
 import numpy as np
 import time
 
@@ -85,6 +89,19 @@ def wavelength_to_rgb(nm):
             rgb["B"] = 155
         return (rgb["R"], rgb["G"], rgb["B"])
 
+#wavelength_to_rgb is only coloured between 380 and 780nm, everything else is gray
+_VISIBLE_NM = np.arange(380,781)
+_VISIBLE_BGR = np.array([wavelength_to_rgb(nm)[::-1] for nm in _VISIBLE_NM],dtype=np.uint8)
+
+def wavelengths_to_bgr(wavelengths):
+    #vectorized wavelength_to_rgb, one BGR row per wavelength (rounded to whole nm)
+    #ready to be used as OpenCV colours
+    nm = np.rint(np.asarray(wavelengths,dtype=float))
+    visible = (nm >= _VISIBLE_NM[0]) & (nm <= _VISIBLE_NM[-1])
+    bgr = np.full((len(nm),3),155,dtype=np.uint8)
+    bgr[visible] = _VISIBLE_BGR[nm[visible].astype(int) - _VISIBLE_NM[0]]
+    return bgr
+
 
 def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     #scipy
@@ -121,8 +138,28 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
     OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
     '''
-    import numpy as np
-    from math import factorial
+    half_window, kernel = savitzky_golay_coefficients(window_size, order, deriv, rate)
+    # pad the signal at the extremes with
+    # values taken from the signal itself
+    padded = _padding_buffer(len(y), half_window)
+    signal = padded[half_window:half_window+len(y)]
+    signal[:] = y
+    first, last = signal[0], signal[-1]
+    firstvals = padded[:half_window]
+    np.subtract(signal[1:half_window+1][::-1], first, out=firstvals)
+    np.abs(firstvals, out=firstvals)
+    np.subtract(first, firstvals, out=firstvals)
+    lastvals = padded[half_window+len(y):]
+    np.subtract(signal[-half_window-1:-1][::-1], last, out=lastvals)
+    np.abs(lastvals, out=lastvals)
+    np.add(last, lastvals, out=lastvals)
+    return np.convolve(kernel, padded, mode='valid')
+
+@lru_cache(maxsize=None)
+def savitzky_golay_coefficients(window_size, order, deriv=0, rate=1):
+    #the Savitzky-Golay kernel only depends on the filter settings, so it is
+    #computed once per setting rather than every frame (see savitzky_golay for licence)
+    #returns (half_window, float32 kernel ready for np.convolve)
     try:
         window_size = np.abs(int(window_size))
         order = np.abs(int(order))
@@ -132,17 +169,95 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
         raise TypeError("window_size size must be a positive odd number")
     if window_size < order + 2:
         raise TypeError("window_size is too small for the polynomials order")
+    if not 0 <= deriv <= order:
+        raise ValueError("deriv must be between 0 and the polynomial order")
     order_range = range(order+1)
     half_window = (window_size -1) // 2
     # precompute coefficients
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
-    # pad the signal at the extremes with
-    # values taken from the signal itself
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve( m[::-1], y, mode='valid')
+    b = np.array([[k**i for i in order_range] for k in range(-half_window, half_window+1)],dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate**deriv * factorial(deriv)
+    kernel = m[::-1].astype(np.float32)
+    kernel.flags.writeable = False
+    return half_window, kernel
+
+_padding_buffers = {}
+
+def _padding_buffer(size, half_window):
+    #float32 scratch space for the padded signal, reused between frames
+    key = (size, half_window)
+    if key not in _padding_buffers:
+        _padding_buffers[key] = np.empty(size + 2*half_window,dtype=np.float32)
+    return _padding_buffers[key]
+
+def savitzky_golay_derivative(y, window_size, order, deriv=1, spacing=1):
+    #smoothed 1st or 2nd derivative of y, for derivative spectroscopy.
+    #spacing is the distance between samples, e.g. nm per pixel, to get the derivative per nm.
+    #savitzky_golay's rate is the other way up, samples per unit
+    if deriv not in (1,2):
+        raise ValueError("only 1st and 2nd derivatives are supported")
+    return savitzky_golay(y, window_size, order, deriv=deriv, rate=1/spacing)
+
+def _window_min(values, lo, hi):
+    #min of values[lo[i]:hi[i]] for every i. A sparse table holds the min of
+    #every power of two block, any window is then covered by two of them
+    levels = [values]
+    while 2**len(levels) <= len(values):
+        width = 2**(len(levels) - 1)
+        levels.append(np.minimum(levels[-1][:-width], levels[-1][width:]))
+    table = np.full((len(levels), len(values)), values.max(), dtype=values.dtype)
+    for k, level in enumerate(levels):
+        table[k, :len(level)] = level
+    k = np.log2(hi - lo).astype(int)
+    return np.minimum(table[k, lo], table[k, hi - (1 << k)])
+
+#most rounds of _suppress_peaks before the rest goes one by one. A round
+#usually settles nearly every peak, but a chain of ever higher peaks closer
+#together than min_dist only settles one or two a round, so it also stops
+#once a round settles less than a quarter of what was left
+SUPPRESS_ROUNDS = 8
+
+def _suppress_greedy(positions, rank, min_dist):
+    #the one by one loop itself, kept peaks are bisected so each visit is O(log k)
+    positions = positions.tolist()
+    kept = []
+    for i in np.argsort(rank).tolist():
+        peak = positions[i]
+        nearest = bisect_left(kept, peak - min_dist)
+        if nearest == len(kept) or kept[nearest] > peak + min_dist:
+            insort(kept, peak)
+    return np.array(kept, dtype=np.int64)
+
+def _suppress_peaks(peaks, order, min_dist):
+    #same result as visiting peaks[order] one by one, keeping each peak not
+    #already within min_dist of a kept one. Done in rounds instead: a peak
+    #that outranks every undecided peak within min_dist would be kept by that
+    #loop, so keep all of those at once, then drop everything within min_dist
+    #of them. Each round is a few sorts and searches over what is left. Peaks
+    #still undecided when the rounds stop are far from every kept one, so the
+    #loop over just them finishes the job, O(k log k) either way
+    rank = np.empty(len(peaks), dtype=np.int64)
+    rank[order] = np.arange(len(peaks))
+    positions = peaks
+    kept = []
+    for _ in range(SUPPRESS_ROUNDS):
+        if not len(positions):
+            break
+        lo = np.searchsorted(positions, positions - min_dist, side='left')
+        hi = np.searchsorted(positions, positions + min_dist, side='right')
+        keep = positions[_window_min(rank, lo, hi) == rank]
+        kept.append(keep)
+        nearest = np.searchsorted(keep, positions)
+        left = keep[np.maximum(nearest - 1, 0)]
+        right = keep[np.minimum(nearest, len(keep) - 1)]
+        decided = (np.abs(positions - left) <= min_dist) | (np.abs(right - positions) <= min_dist)
+        settled = np.count_nonzero(decided)
+        positions = positions[~decided]
+        rank = rank[~decided]
+        if settled * 4 < settled + len(positions):
+            break
+    if len(positions):
+        kept.append(_suppress_greedy(positions, rank, min_dist))
+    return np.sort(np.concatenate(kept))
 
 def peakIndexes(y, thres=0.3, min_dist=1, thres_abs=False):
     #from peakutils
@@ -189,30 +304,19 @@ def peakIndexes(y, thres=0.3, min_dist=1, thres_abs=False):
         return np.array([])
 
     if len(zeros):
-        # compute first order difference of zero indexes
-        zeros_diff = np.diff(zeros)
-        # check when zeros are not chained together
-        zeros_diff_not_one, = np.add(np.where(zeros_diff != 1), 1)
-        # make an array of the chained zero indexes
-        zero_plateaus = np.split(zeros, zeros_diff_not_one)
-
-        # fix if leftmost value in dy is zero
-        if zero_plateaus[0][0] == 0:
-            dy[zero_plateaus[0]] = dy[zero_plateaus[0][-1] + 1]
-            zero_plateaus.pop(0)
-
-        # fix if rightmost value of dy is zero
-        if len(zero_plateaus) and zero_plateaus[-1][-1] == len(dy) - 1:
-            dy[zero_plateaus[-1]] = dy[zero_plateaus[-1][0] - 1]
-            zero_plateaus.pop(-1)
-
-        # for each chain of zero indexes
-        for plateau in zero_plateaus:
-            median = np.median(plateau)
-            # set leftmost values to leftmost non zero values
-            dy[plateau[plateau < median]] = dy[plateau[0] - 1]
-            # set rightmost and middle values to rightmost non zero values
-            dy[plateau[plateau >= median]] = dy[plateau[-1] + 1]
+        # first and last zero index of the plateau each zero belongs to
+        breaks = np.flatnonzero(np.diff(zeros) != 1) + 1
+        lengths = np.diff(np.concatenate(([0], breaks, [len(zeros)])))
+        starts = np.repeat(zeros[np.concatenate(([0], breaks))], lengths)
+        ends = np.repeat(zeros[np.concatenate((breaks - 1, [len(zeros) - 1]))], lengths)
+
+        # leftmost values take the leftmost non zero value, rightmost and middle
+        # values the rightmost. A plateau at the start of dy takes the value
+        # after it throughout, one at the end the value before it
+        before = dy[np.maximum(starts - 1, 0)]
+        after = dy[np.minimum(ends + 1, len(dy) - 1)]
+        take_after = ((zeros >= (starts + ends) / 2) | (starts == 0)) & (ends != len(dy) - 1)
+        dy[zeros] = np.where(take_after, after, before)
 
     # find the peaks by using the first order difference
     peaks = np.where(
@@ -223,46 +327,53 @@ def peakIndexes(y, thres=0.3, min_dist=1, thres_abs=False):
 
     # handle multiple peaks, respecting the minimum distance
     if peaks.size > 1 and min_dist > 1:
-        highest = peaks[np.argsort(y[peaks])][::-1]
-        rem = np.ones(y.size, dtype=bool)
-        rem[peaks] = False
-
-        for peak in highest:
-            if not rem[peak]:
-                sl = slice(max(0, peak - min_dist), peak + min_dist + 1)
-                rem[sl] = True
-                rem[peak] = False
-
-        peaks = np.arange(y.size)[~rem]
+        peaks = _suppress_peaks(peaks, np.argsort(y[peaks])[::-1], min_dist)
 
     return peaks    
 
-def nm_labels(wavelengths,step):
-    last_labeled = round(wavelengths[0]/step) * step
-    for x,nm in enumerate(wavelengths):
-        if nm >= last_labeled + step:
-            nm_floor = round(nm)/step*step
-            label = nm_floor
-            yield (label,x)
-            last_labeled = nm_floor
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+PEAK_METHODS = ('parabolic','gaussian','centroid')
+
+def refine_peaks(y, indexes, wavelengths=None, method='parabolic', half_width=2):
+    """
+    Sub-pixel position and height of every peak in indexes at once.
+
+    parabolic fits a parabola through each peak and its two neighbours,
+    gaussian does the same on log(y) (exact for gaussian lines), centroid
+    takes the intensity weighted mean over peak +-half_width, above the
+    lowest point of that window.
+
+    Returns (fractional pixel positions, wavelengths interpolated from the
+    per pixel wavelengths, or None without them, heights).
+    """
+    if method not in PEAK_METHODS:
+        raise ValueError(f"Unknown peak method {method!r}, expected one of {PEAK_METHODS}")
+    y = np.asarray(y, dtype=np.float64)
+    indexes = np.asarray(indexes, dtype=int)
+    last = len(y) - 1
+    if method == 'centroid':
+        window = np.clip(indexes[:,None] + np.arange(-half_width, half_width+1), 0, last)
+        weights = y[window]
+        weights = weights - weights.min(axis=1, keepdims=True)
+        total = weights.sum(axis=1)
+        offset = (weights * (window - indexes[:,None])).sum(axis=1) / np.where(total > 0, total, 1)
+        positions = indexes + offset
+        heights = y[indexes]
+    else:
+        left = y[np.maximum(indexes - 1, 0)]
+        center = y[indexes]
+        right = y[np.minimum(indexes + 1, last)]
+        if method == 'gaussian':
+            #log of zero is no use, anything below 1 count is noise anyway
+            left, center, right = (np.log(np.maximum(v, 1)) for v in (left, center, right))
+        curvature = left - 2*center + right
+        #only a peak (curvature < 0) has a vertex, leave anything else where it is
+        offset = np.where(curvature < 0, 0.5*(left - right) / np.where(curvature < 0, curvature, -1), 0)
+        offset = np.clip(offset, -0.5, 0.5)
+        heights = center - 0.25*(left - right)*offset
+        if method == 'gaussian':
+            heights = np.exp(heights)
+        positions = indexes + offset
+    if wavelengths is None:
+        return positions, None, heights
+    nm = np.interp(positions, np.arange(len(wavelengths)), wavelengths)
+    return positions, nm, heights
@@ -1,11 +1,21 @@
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+import time
 
+import cv2
 import numpy as np
 
 from . import video
+from .archive import ArchiveWriter
+from .correction import Correction
+from .history import Average
+from .metrics import Timings
 from .record import Calibration
-from .specFunctions import nm_labels
+from .specFunctions import peakIndexes, refine_peaks, savitzky_golay
+
+#single channels in the order OpenCV stores them
+CHANNELS = ('blue','green','red')
 
 @dataclass
 class Spectrometer:
@@ -16,26 +26,130 @@ class Spectrometer:
     mindist: int = 50 #minumum distance between peaks max val 100
     thresh: int = 20 #Threshold max val 100
     holdpeaks: bool = False
+    peak_method: str = 'parabolic' #sub-pixel peak fit: parabolic, gaussian or centroid
+    sample_count: int = 3 #rows of the preview averaged into the spectrum
+    channel: str = 'luma' #how colour is combined: luma, max, or just blue, green or red
+    average_mode: str = 'off' #temporal averaging: off, boxcar or ema
+    average_n: int = 16 #frames in the boxcar, or the ema's equivalent window
+    timings: Timings = field(default_factory=Timings,repr=False)
 
     def __post_init__(self):
-        self.intensity = [0] * self.calibration.width #array for intensity data...full of zeroes
+        self.intensity = np.zeros(self.calibration.width,dtype=np.uint8) #array for intensity data...full of zeroes
+        self.peaks = np.array([],dtype=int) #pixel indexes of the labelled peaks
+        #and their sub-pixel refined positions, wavelengths and heights
+        self.peak_positions = self.peak_wavelengths = self.peak_heights = np.array([])
+        self.recorder = None #ArchiveWriter while recording every spectrum
+        self.average = Average(self.calibration.width,self.average_n,self.average_mode)
+        #the saved dark and flat are only loaded when asked, see Correction.load
+        self.correction = Correction(self.calibration.width,directory=Path(self.calibration.filename).parent)
 
     @property
     def tens(self):
-        return nm_labels(self.calibration.wavelengthData,step=10)
+        return self.calibration.ticks(10)
 
     @property
     def fifties(self):
-        return nm_labels(self.calibration.wavelengthData,step=50)
+        return self.calibration.ticks(50)
     
-    def sample_intensity(self,preview,sample_count=3):
+    def sample_intensity(self,preview,sample_count=None,dtype=np.uint8):
+        #average sample_count rows around the middle of the preview, one value per column.
+        #integer dtypes round down, pass a float dtype (e.g. np.float32) to keep the fraction
+        sample_count = sample_count or self.sample_count
         crop_center = len(preview) // 2
         self.sample_start = max(0,crop_center - sample_count // 2)
         self.sample_stop = min(len(preview), self.sample_start + sample_count)
-        sample = preview[self.sample_start:self.sample_stop]
-        intensities = [sum(col)//len(col) for col in zip(*sample)]
+        #only the sampled rows are ever converted to one channel
+        sample = self.single_channel(preview[self.sample_start:self.sample_stop])
+        if np.issubdtype(dtype,np.floating):
+            intensities = sample.mean(axis=0,dtype=dtype)
+        else:
+            intensities = (sample.sum(axis=0,dtype=np.uint32) // len(sample)).astype(dtype)
         if self.holdpeaks:
-           self.intensity = [max(previous,current) for previous,current in zip(self.intensity,intensities)]
+           if self.intensity.dtype != intensities.dtype:
+               self.intensity = self.intensity.astype(intensities.dtype)
+           np.maximum(self.intensity,intensities,out=self.intensity)
         else:
            self.intensity = intensities
-        self.intensity = np.uint8(self.intensity)
\ No newline at end of file
+
+    def single_channel(self,rows):
+        "rows of a BGR image as one channel. Gray or Y plane (2D) images are already there"
+        if rows.ndim == 2:
+            return rows
+        if self.channel == 'luma':
+            return cv2.cvtColor(rows,cv2.COLOR_BGR2GRAY)
+        if self.channel == 'max':
+            return rows.max(axis=2)
+        return rows[:,:,CHANNELS.index(self.channel)]
+
+    def process(self,preview,timestamp=None):
+        #one frame through the pipeline: sample -> average -> correct -> smooth -> find peaks -> record.
+        #no drawing, so this is shared by the GUI and headless mode
+        with self.timings.stage('binning'):
+            self.sample_intensity(preview)
+        raw = self.intensity
+        #holding peaks is its own accumulator, don't average or correct on top of it
+        if self.average_mode != 'off' and not self.holdpeaks:
+            with self.timings.stage('average'):
+                self.average.set_mode(self.average_mode)
+                self.average.set_n(self.average_n)
+                self.intensity = self.average.update(self.intensity)
+        if self.correction.active and not self.holdpeaks:
+            with self.timings.stage('correction'):
+                #dark and flat captures average the raw spectra, whatever else is going on
+                self.correction.feed(raw)
+                self.intensity = self.correction.apply(self.intensity)
+        #filter if not holding peaks!
+        if not self.holdpeaks:
+            with self.timings.stage('filter'):
+                self.intensity = savitzky_golay(self.intensity,17,self.savpoly).astype(int)
+        with self.timings.stage('peaks'):
+            self.peaks = self.find_peaks()
+            self.peak_positions, self.peak_wavelengths, self.peak_heights = refine_peaks(
+                self.intensity,self.peaks,self.calibration.wavelengthData,self.peak_method)
+        if self.recorder is not None:
+            with self.timings.stage('record'):
+                self.recorder.append(timestamp or time.time(),self.intensity)
+        return self.intensity
+
+    def cycle_average_mode(self):
+        modes = Average.modes
+        self.average_mode = modes[(modes.index(self.average_mode) + 1) % len(modes)]
+
+    @property
+    def average_label(self):
+        if self.average_mode == 'off' or self.holdpeaks:
+            return "Average: OFF"
+        return f"Average: {self.average_mode} {len(self.average)}/{self.average_n}"
+
+    def capture_correction(self, kind):
+        "start averaging the next average_n frames into the dark or flat spectrum"
+        self.correction.start_capture(kind,self.average_n)
+
+    def find_peaks(self):
+        thresh = int(self.thresh) #make sure the data is int.
+        return peakIndexes(self.intensity, thres=thresh/np.max(self.intensity), min_dist=self.mindist)
+
+    @property
+    def settings(self):
+        settings = {f.name:getattr(self,f.name) for f in fields(self) if f.name not in ('calibration','timings')}
+        settings['calibration'] = {'pixels': self.calibration.pixels, 'wavelengths': self.calibration.wavelengths}
+        settings['correction'] = self.correction.settings
+        return settings
+
+    def start_recording(self, filename=None, compression=None):
+        #append every processed spectrum to an archive until stop_recording()
+        if filename is None:
+            filename = "recording-" + time.strftime("%Y%m%d--%H%M%S") + ".spectra"
+        self.stop_recording()
+        self.recorder = ArchiveWriter(filename,self.calibration.wavelengthData,
+            settings=self.settings,compression=compression)
+        return filename
+
+    def stop_recording(self):
+        "close the archive, returns how many spectra it holds"
+        if self.recorder is None:
+            return 0
+        self.recorder.close()
+        count = self.recorder.count
+        self.recorder = None
+        return count
@@ -1,18 +1,115 @@
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
 from importlib.resources import files
+import threading
 from typing import List
 
 import cv2
 import numpy as np
 
 
+@lru_cache
 def logo():
-    #banner image
+    #banner image, decoded once. Read only, copy it before drawing on it
     background = files('pyspectrometer2').joinpath("static/background.png").read_bytes()
     np_data = np.frombuffer(background,np.uint8)
     mat = cv2.imdecode(np_data,3)
+    mat.flags.writeable = False
     return mat
 
+@dataclass
+class Sprite():
+    color: np.ndarray #the text's colour scaled by its coverage, what blending adds on top
+    inverse: np.ndarray #255 - coverage per channel, what is kept of the background
+    origin: tuple #where the text's origin (bottom left) sits in the sprite
+
+    @property
+    def nbytes(self):
+        return self.color.nbytes + self.inverse.nbytes
+
+
+class TextCache():
+    """
+    Least recently used cache of rendered text. Each sprite is the text drawn
+    once, with its alpha, so drawing it again is a blend instead of
+    rasterizing every glyph. Sprites are dropped, oldest use first, once they
+    take more than maxbytes. Safe to share between render threads.
+    """
+
+    def __init__(self, maxbytes=4*1024*1024):
+        self.sprites = OrderedDict()
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def sprite(self, text, font, scale, color, thickness=1, lineType=cv2.LINE_AA):
+        with self.lock:
+            return self._sprite((text,font,scale,color,thickness,lineType))
+
+    def _sprite(self, key):
+        try:
+            sprite = self.sprites[key]
+        except KeyError:
+            pass
+        else:
+            self.sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+        self.misses += 1
+        sprite = self.render(*key)
+        self.sprites[key] = sprite
+        self.nbytes += sprite.nbytes
+        while self.nbytes > self.maxbytes and len(self.sprites) > 1:
+            _, dropped = self.sprites.popitem(last=False)
+            self.nbytes -= dropped.nbytes
+        return sprite
+
+    @staticmethod
+    def render(text, font, scale, color, thickness, lineType):
+        (w,h),baseline = cv2.getTextSize(text,font,scale,thickness)
+        pad = thickness + 1 #glyphs can reach a little outside their box
+        origin = (pad,pad+h)
+        coverage = np.zeros([h+baseline+2*pad,w+2*pad],dtype=np.uint8)
+        cv2.putText(coverage,text,origin,font,scale,255,thickness,lineType)
+        coverage = coverage[:,:,None].astype(np.uint16)
+        premultiplied = ((coverage*np.array(color,dtype=np.uint16) + 127) // 255).astype(np.uint8)
+        inverse = np.repeat(255 - coverage,3,axis=2).astype(np.uint8)
+        return Sprite(premultiplied,inverse,origin)
+
+    def put_text(self, img, text, org, font, scale, color, thickness=1, lineType=cv2.LINE_AA):
+        "cv2.putText from the cache, clipped to img. color must be a tuple"
+        sprite = self.sprite(text,font,scale,color,thickness,lineType)
+        inverse, premultiplied = sprite.inverse, sprite.color
+        h,w = inverse.shape[:2]
+        x = org[0] - sprite.origin[0]
+        y = org[1] - sprite.origin[1]
+        if x < 0 or y < 0 or x + w > img.shape[1] or y + h > img.shape[0]:
+            left, top = max(0,-x), max(0,-y)
+            right, bottom = min(w,img.shape[1] - x), min(h,img.shape[0] - y)
+            if left >= right or top >= bottom:
+                return
+            inverse = inverse[top:bottom,left:right]
+            premultiplied = premultiplied[top:bottom,left:right]
+            x += left
+            y += top
+            h, w = bottom - top, right - left
+        roi = img[y:y+h,x:x+w]
+        #roi * (1 - alpha) + color * alpha, in 8 bit
+        cv2.multiply(roi,inverse,dst=roi,scale=1/255)
+        cv2.add(roi,premultiplied,dst=roi)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'sprites': len(self.sprites), 'bytes': self.nbytes}
+
+
+#shared by everything that draws text every frame
+text_cache = TextCache()
+
+
 @dataclass
 class Coordinates():
     x: int
@@ -75,35 +172,39 @@ class Overlay():
             'savpoly': (640,33),
             'label_width': (640,51),
             'label_threshold': (640,69),
+            'average': (20,69),
+            'correction': (180,69),
         }
 
         location = locations[label]
         color = (0,255,255)
         thickness = 1
-        cv2.putText(self.mat,msg,location,self.font,self.scale,color,thickness,lineType=cv2.LINE_AA)
+        text_cache.put_text(self.mat,msg,location,self.font,self.scale,color,thickness)
 
-    def show_measure(self, cursor_offset_px=5, wavelengthData=None):
+    def show_measure(self, cursor_offset_px=5, wavelengthData=None, pixelData=None):
         """
         If wavelengthData is provided, display the wavelength corresponding to
-        cursor position. Otherwise, display the cursor position in px.
+        cursor position. Otherwise, display the cursor position in px, mapped
+        to a sensor pixel by pixelData if the window is narrower than the sensor.
         """
-        if wavelengthData:
+        if wavelengthData is not None:
             wavelength = wavelengthData[self.cursor.x]
             label = f"{wavelength:0.2f}nm"
         else: 
-            label = f"{self.cursor.x}px"
+            pixel = pixelData(self.cursor.x) if pixelData else self.cursor.x
+            label = f"{pixel}px"
         x = self.cursor.x
         x += cursor_offset_px # right of cursor
         y = self.cursor.y
         y -= cursor_offset_px # above cursor
         color = (0,0,0)
 
-        cv2.putText(
+        text_cache.put_text(
             self.mat,
             label,
             (x,y),
             self.font,self.scale,color,
-            thickness=1, lineType=cv2.LINE_AA)
+            thickness=1)
 
     def show_cursor(self,rectile_size_px=40):
         #show the cursor!
@@ -123,7 +224,7 @@ class Overlay():
            color=color,
            thickness=1)
     
-    def show_calibration_choices(self, radius=5, label_offset_px=5):
+    def show_calibration_choices(self, radius=5, label_offset_px=5, pixelData=None):
         color = (0,0,0)
         for idx,click in enumerate(self.clicks):
             center = (click.x,click.y)
@@ -132,19 +233,129 @@ class Overlay():
             #and display it ultimately
             x = click.x + label_offset_px
             y = click.y
-            label = f"{idx}:{click.x}px"
-            cv2.putText(self.mat,label,(x,y),self.font,self.scale,color)
+            pixel = pixelData(click.x) if pixelData else click.x
+            label = f"{idx}:{pixel}px"
+            text_cache.put_text(self.mat,label,(x,y),self.font,self.scale,color,lineType=cv2.LINE_8)
     
     @classmethod
     def clear_claibration_clicks(cls):
         cls.clicks = []
 
-    @classmethod
-    def background(cls,width):
-        "all black background, with logo overlay"
-        bg = np.zeros([cls.message_height,width,3],dtype=np.uint8)
-        img = logo()
-        h = min(bg.shape[0],img.shape[0])
-        w = min(bg.shape[1],img.shape[1])
-        bg[0:h,0:w] = img[0:h,0:w]
-        return bg
\ No newline at end of file
+
+@lru_cache
+def _background(height, width):
+    #read only, like logo()
+    bg = np.zeros([height,width,3],dtype=np.uint8)
+    img = logo()
+    h = min(bg.shape[0],img.shape[0])
+    w = min(bg.shape[1],img.shape[1])
+    bg[0:h,0:w] = img[0:h,0:w]
+    bg.flags.writeable = False
+    return bg
+
+
+class Compositor():
+    """
+    The image shown in one window, allocated once: the header (logo and
+    labels), the camera preview and the graph or waterfall stacked on top of
+    each other. header, preview and body are fixed views into canvas, so a
+    frame is drawn by writing into them in place.
+    """
+
+    def __init__(self, width, message_height=80, preview_height=80, body_height=320):
+        self.canvas = np.zeros([message_height+preview_height+body_height,width,3],dtype=np.uint8)
+        self.header = self.canvas[:message_height]
+        self.preview = self.canvas[message_height:message_height+preview_height]
+        self.body = self.canvas[message_height+preview_height:]
+        self.background = _background(message_height,width)
+
+    def compose(self, preview):
+        "restore the header and copy in the preview, the body is drawn by the caller"
+        np.copyto(self.header,self.background)
+        np.copyto(self.preview,preview)
+        return self.canvas
+
+
+class Graticule():
+    """
+    Static graph and waterfall markings. They only depend on the calibration
+    and the window size, so they are drawn once and reused every frame until
+    one of those changes.
+    """
+    hline_color = (100,100,100)
+    vminor_color = (200,200,200)
+    vmajor_color = (0,0,0)
+    textoffset = 12
+
+    def __init__(self, font=cv2.FONT_HERSHEY_SIMPLEX, scale=0.4):
+        self.font = font
+        self.scale = scale
+        self.key = None
+
+    def matches(self, calibration, width, height):
+        #the same calibration object, and the same size by value, it may be a python or a numpy int
+        if self.key is None:
+            return False
+        key_calibration, key_width, key_height = self.key
+        return calibration is key_calibration and width == key_width and height == key_height
+
+    def update(self, calibration, width, height):
+        "rebuild the cached layers if the calibration or size changed"
+        key = (calibration, width, height)
+        if self.matches(*key):
+            return False
+        self.key = key
+        tens = calibration.ticks(10)
+        fifties = calibration.ticks(50)
+        self.spectrum = self.draw_spectrum(tens,fifties,width,height)
+        #every column's colour down the whole graph, the trace's fill is masked out of it
+        self.fill = np.ascontiguousarray(np.broadcast_to(calibration.colorData,(height,width,3)))
+        self.draw_waterfall(fifties,width,height)
+        return True
+
+    def updated(self, calibration, width, height):
+        "this graticule if it still matches, otherwise a new one, so one a render thread holds never changes"
+        if self.matches(calibration,width,height):
+            return self
+        graticule = Graticule(self.font,self.scale) if self.key is not None else self
+        graticule.update(calibration,width,height)
+        return graticule
+
+    def draw_spectrum(self, tens, fifties, width, height):
+        #white graph background
+        graph = np.full([height,width,3],255,dtype=np.uint8)
+
+        #vertial lines every whole 10nm
+        for label,x in tens:
+            cv2.line(graph,(x,15),(x,height),self.vminor_color,1)
+
+        #vertical lines every whole 50nm
+        for label,x in fifties:
+            cv2.line(graph,(x,15),(x,height),self.vmajor_color,1)
+            text_cache.put_text(graph,f'{label:n}nm',(x-self.textoffset,12),self.font,self.scale,(0,0,0),1)
+
+        #horizontal lines
+        for y in range(64, height, 64):
+            cv2.line(graph,(0,y),(width,y),self.hline_color,1)
+        return graph
+
+    def draw_waterfall(self, fifties, width, height):
+        #dashed lines and labels every 50nm, drawn over the waterfall.
+        #only the marked pixels are kept so they can be written straight over the history
+        layer = np.zeros([height,width,3],dtype=np.uint8)
+        mask = np.zeros([height,width],dtype=np.uint8)
+        for label,x in fifties:
+            for y in range(20, height, 20):
+                cv2.line(layer,(x,y),(x,y+1),(0,0,0),2)
+                cv2.line(mask,(x,y),(x,y+1),255,2)
+                cv2.line(layer,(x,y),(x,y+1),(255,255,255),1)
+            org = (x-self.textoffset,height-5)
+            cv2.putText(layer,f'{label:n}nm',org,self.font,self.scale,(0,0,0),2, cv2.LINE_AA)
+            cv2.putText(mask,f'{label:n}nm',org,self.font,self.scale,255,2, cv2.LINE_AA)
+            cv2.putText(layer,f'{label:n}nm',org,self.font,self.scale,(255,255,255),1, cv2.LINE_AA)
+        self.waterfall_pixels = np.nonzero(mask)
+        self.waterfall = layer[self.waterfall_pixels]
+
+    def apply_waterfall(self, rows):
+        "write the waterfall markings over rows (height x width x 3) in place"
+        rows[self.waterfall_pixels] = self.waterfall
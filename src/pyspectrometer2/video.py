@@ -1,39 +1,191 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+import threading
+import time
+from warnings import warn
+
 import cv2
+import numpy as np
+
+
+@dataclass
+class Frame():
+    image: np.ndarray
+    timestamp: float #time.time() when the frame came off the device
+    dropped: int = 0 #frames the background reader had thrown away by then
+
+
+class FrameReader():
+    """
+    Reads frames on a background thread into a bounded queue, so a slow
+    render or save never holds up the device.
+
+    policy 'latest' keeps only the newest maxsize frames and counts the rest
+    as dropped, 'all' keeps every frame and stalls the reader while the queue
+    is full.
+
+    close, if given, is called on the reader thread once it has finished
+    reading. stop() can time out while a read is still blocked, so the
+    source is only released after that read has returned.
+    """
+    policies = ('latest','all')
+
+    def __init__(self, read, policy='latest', maxsize=None, close=None):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown reader policy {policy!r}, expected one of {self.policies}")
+        self.read = read
+        self.close = close
+        self.policy = policy
+        self.maxsize = maxsize or (1 if policy == 'latest' else 64)
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.run,name='FrameReader',daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self, timeout=1):
+        "True once the thread has finished, False if it is still stuck in a read"
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def run(self):
+        try:
+            self.read_frames()
+        finally:
+            if self.close is not None:
+                self.close()
 
-class Capture(cv2.VideoCapture):
+    def read_frames(self):
+        while self.running:
+            success, image = self.read()
+            timestamp = time.time()
+            with self.condition:
+                if not success:
+                    self.running = False
+                    self.condition.notify_all()
+                    break
+                if self.policy == 'all':
+                    while self.running and len(self.frames) >= self.maxsize:
+                        self.condition.wait()
+                elif len(self.frames) >= self.maxsize:
+                    self.frames.popleft()
+                    self.dropped += 1
+                self.frames.append(Frame(image,timestamp,self.dropped))
+                self.condition.notify_all()
 
-    def __init__(self, *args, preview_origin = 0, preview_height = 80, **kwargs):
-        super().__init__(*args,**kwargs)
+    def get(self):
+        "next queued frame, waiting for one if needed. None once the reader has stopped"
+        with self.condition:
+            while self.running and not self.frames:
+                self.condition.wait()
+            if not self.frames:
+                return None
+            frame = self.frames.popleft()
+            self.condition.notify_all()
+            return frame
+
+
+class FrameSource(ABC):
+    """
+    Anything the spectrometer can read frames from. Subclasses provide
+    width, height, fps and read_image(), this handles the preview crop,
+    the optional background reader and pacing of replayed sources.
+
+    pacing 'fast' hands out frames as quickly as they can be produced,
+    'realtime' holds them back to the source's frame rate.
+    """
+    pacings = ('fast','realtime')
+
+    def __init__(self, preview_origin = 0, preview_height = 80, pacing = 'fast'):
+        if pacing not in self.pacings:
+            raise ValueError(f"Unknown pacing {pacing!r}, expected one of {self.pacings}")
         self.crop_offset = preview_origin
         self.preview_height = preview_height
+        self.pacing = pacing
+        self.next_frame_time = None
+        self.reader = None
+        self.frame = None #the last Frame returned by read()
 
     @property
+    @abstractmethod
     def width(self):
-        return int(self.get(cv2.CAP_PROP_FRAME_WIDTH))
+        ...
 
     @property
+    @abstractmethod
     def height(self):
-        return int(self.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        ...
 
     @property
+    @abstractmethod
     def fps(self):
-        return int(self.get(cv2.CAP_PROP_FPS))
+        ...
 
+    @abstractmethod
+    def read_image(self):
+        "(success, image) for the next frame"
 
-    @classmethod
-    def initialize(cls, device="0", width=800, height=600, fps=30):
-        #init video
-        cap = cls('/dev/video'+device, cv2.CAP_V4L)
-        #cap = cv2.VideoCapture(0)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH,width)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
-        cap.set(cv2.CAP_PROP_FPS,fps)
-        return cap
+    def isOpened(self):
+        "True while there may be frames left to read"
+        if self.reader is not None:
+            #the device belongs to the reader thread, and queued frames are still to be handed out
+            return self.reader.running or bool(self.reader.frames)
+        return self.opened()
+
+    def opened(self):
+        return True
+
+    def close(self):
+        pass
+
+    @property
+    def dropped(self):
+        return self.reader.dropped if self.reader else 0
+
+    def paced_read(self):
+        if self.pacing == 'realtime' and self.fps > 0:
+            now = time.monotonic()
+            if self.next_frame_time is not None and now < self.next_frame_time:
+                time.sleep(self.next_frame_time - now)
+                now = self.next_frame_time
+            self.next_frame_time = now + 1/self.fps
+        return self.read_image()
+
+    def start_reader(self, policy='latest', maxsize=None):
+        #read from the source on a background thread from now on
+        #the reader releases the source itself, it may still be reading when release() gives up waiting
+        self.reader = FrameReader(self.paced_read,policy=policy,maxsize=maxsize,close=self.close)
+        self.reader.start()
+
+    def read(self):
+        if self.reader is None:
+            success, image = self.paced_read()
+            self.frame = Frame(image,time.time()) if success else None
+        else:
+            self.frame = self.reader.get()
+            success = self.frame is not None
+            image = self.frame.image if success else None
+        return success, image
+
+    def release(self):
+        if self.reader is None:
+            self.close()
+        elif not self.reader.stop():
+            warn("Frame reader is still blocked in a read, the source will be released when it returns")
 
     @property
     def crop_start(self):
         return self.height//2 + self.crop_offset
-    
+
     def cropped_preview(self, frame):
         y = self.crop_start
         x = 0     #origin of the horiz crop
@@ -53,4 +205,169 @@ class Capture(cv2.VideoCapture):
 
 
     def __str__(self):
-        return f"[info] W={self.width}, H={self.height}, FPS={self.fps}"
\ No newline at end of file
+        return f"[info] W={self.width}, H={self.height}, FPS={self.fps}"
+
+
+class Capture(FrameSource):
+    "a V4L video device, or anything else cv2.VideoCapture can open"
+
+    def __init__(self, *args, preview_origin = 0, preview_height = 80, pacing = 'fast', **kwargs):
+        super().__init__(preview_origin,preview_height,pacing)
+        self.video = cv2.VideoCapture(*args,**kwargs)
+        self.properties = None #width, height and fps, fixed once a reader owns the device
+
+    @property
+    def width(self):
+        return self.get(cv2.CAP_PROP_FRAME_WIDTH)
+
+    @property
+    def height(self):
+        return self.get(cv2.CAP_PROP_FRAME_HEIGHT)
+
+    @property
+    def fps(self):
+        return self.get(cv2.CAP_PROP_FPS)
+
+    def get(self, prop):
+        #cv2.VideoCapture isn't thread safe, so with a reader reading it use the values from before it started
+        if self.properties is not None:
+            return self.properties[prop]
+        return int(self.video.get(prop))
+
+    def start_reader(self, policy='latest', maxsize=None):
+        props = (cv2.CAP_PROP_FRAME_WIDTH,cv2.CAP_PROP_FRAME_HEIGHT,cv2.CAP_PROP_FPS)
+        self.properties = {prop:int(self.video.get(prop)) for prop in props}
+        super().start_reader(policy=policy,maxsize=maxsize)
+
+
+    @classmethod
+    def initialize(cls, device="0", width=800, height=600, fps=30):
+        #init video
+        cap = cls('/dev/video'+device, cv2.CAP_V4L)
+        #cap = cv2.VideoCapture(0)
+        cap.video.set(cv2.CAP_PROP_FRAME_WIDTH,width)
+        cap.video.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
+        cap.video.set(cv2.CAP_PROP_FPS,fps)
+        return cap
+
+    def read_image(self):
+        return self.video.read()
+
+    def opened(self):
+        return self.video.isOpened()
+
+    def close(self):
+        self.video.release()
+
+
+class VideoFile(Capture):
+    "replay a recorded video file"
+
+    def __init__(self, path, pacing='fast', **kwargs):
+        super().__init__(str(path),pacing=pacing,**kwargs)
+        if not self.video.isOpened():
+            raise FileNotFoundError(f"Unable to open video file {path}")
+
+
+class ImageDirectory(FrameSource):
+    "replay a directory of PNG frames in filename order"
+
+    def __init__(self, path, fps=30, loop=False, pacing='fast', **kwargs):
+        super().__init__(pacing=pacing,**kwargs)
+        self.paths = sorted(Path(path).glob('*.png'))
+        if not self.paths:
+            raise FileNotFoundError(f"No PNG frames in {path}")
+        self.loop = loop
+        self.index = 0
+        self._fps = fps
+        first = cv2.imread(str(self.paths[0]))
+        if first is None:
+            raise ValueError(f"Unable to read PNG frame {self.paths[0]}")
+        self._height, self._width = first.shape[:2]
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def fps(self):
+        return self._fps
+
+    def opened(self):
+        return self.loop or self.index < len(self.paths)
+
+    def read_image(self):
+        if self.index >= len(self.paths):
+            if not self.loop:
+                return False, None
+            self.index = 0
+        image = cv2.imread(str(self.paths[self.index]))
+        self.index += 1
+        return image is not None, image
+
+
+class SyntheticSpectrum(FrameSource):
+    """
+    Generates frames of a spectrum with gaussian emission lines and noise,
+    so the pipeline can run without a camera.
+
+    lines are (wavelength nm, peak intensity 0-255, FWHM nm). wavelengths
+    gives the wavelength of every column, by default a linear 380-750nm.
+    Only a band of rows around the sampled part of the preview is lit, like
+    the light from a spectroscope slit, and every channel gets the same value.
+    """
+    #a few fluorescent lamp lines: mercury, terbium and europium
+    default_lines = ((405.4,120,2),(436.6,200,2),(487.7,90,3),(542.4,150,3),(546.5,230,2),(611.6,180,3),(631.1,80,3))
+
+    def __init__(self, width=800, height=600, fps=30, lines=default_lines, wavelengths=None,
+                 noise=3.0, background=10, band_height=120, seed=None, pacing='fast', **kwargs):
+        super().__init__(pacing=pacing,**kwargs)
+        self._width = width
+        self._height = height
+        self._fps = fps
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        if wavelengths is None:
+            wavelengths = np.linspace(380,750,width)
+        wavelengths = np.asarray(wavelengths,dtype=np.float32)
+
+        self.profile = np.full(width,background,dtype=np.float32)
+        for nm,peak,fwhm in lines:
+            sigma = fwhm / 2.3548
+            self.profile += peak * np.exp(-0.5*((wavelengths-nm)/sigma)**2)
+
+        #vertical fall off of the lit band, centred on the middle of the preview
+        #where the spectrum is sampled
+        band_height = min(band_height,height)
+        center = self.crop_start + self.preview_height//2
+        self.band_start = min(max(0,center - band_height//2),height - band_height)
+        rows = np.arange(band_height,dtype=np.float32) - band_height/2
+        self.band_profile = np.exp(-0.5*(rows/(band_height/4))**2)[:,None]
+        self.image = np.zeros([height,width,3],dtype=np.uint8)
+        self.band = np.empty([band_height,width],dtype=np.float32)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def fps(self):
+        return self._fps
+
+    def read_image(self):
+        band = self.band
+        np.multiply(self.band_profile,self.profile,out=band)
+        if self.noise:
+            band += self.rng.normal(0,self.noise,band.shape).astype(np.float32)
+        np.clip(band,0,255,out=band)
+        image = self.image.copy()
+        image[self.band_start:self.band_start+len(band)] = band[:,:,None]
+        return True, image
@@ -0,0 +1,30 @@
+"""
+savitzky_golay_derivative on polynomials it must fit exactly, up to the
+float32 kernel.
+"""
+import numpy as np
+import pytest
+
+from pyspectrometer2.specFunctions import savitzky_golay_derivative
+
+
+@pytest.mark.parametrize('spacing', (0.25, 0.5, 1, 2))
+def test_first_derivative(spacing):
+    x = np.arange(200) * spacing
+    y = x**2
+    dy = savitzky_golay_derivative(y, 17, 3, deriv=1, spacing=spacing)
+    #the ends are padded by reflection, so only check where the window fits
+    np.testing.assert_allclose(dy[8:-8], 2 * x[8:-8], rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize('spacing', (0.25, 0.5, 1, 2))
+def test_second_derivative(spacing):
+    x = np.arange(200) * spacing
+    y = x**3 - 4 * x**2
+    d2y = savitzky_golay_derivative(y, 17, 3, deriv=2, spacing=spacing)
+    np.testing.assert_allclose(d2y[8:-8], 6 * x[8:-8] - 8, rtol=1e-5, atol=1e-3)
+
+
+def test_third_derivative_unsupported():
+    with pytest.raises(ValueError):
+        savitzky_golay_derivative(np.arange(50.0), 17, 3, deriv=3)
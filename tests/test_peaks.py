@@ -0,0 +1,138 @@
+"""
+peakIndexes against the loop version it replaced, which is kept here as the
+reference. Both must return the same peaks, in the same order and dtype.
+"""
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from pyspectrometer2.specFunctions import peakIndexes, savitzky_golay
+
+MEDIA = Path(__file__).parent.parent / "media"
+MIN_DISTS = (0, 1, 2, 3, 5, 10, 50, 100)
+
+
+def reference_peakIndexes(y, thres=0.3, min_dist=1, thres_abs=False):
+    #peakIndexes as it was before vectorizing, from peakutils (MIT, Lucas Hermann Negri)
+    if not thres_abs:
+        thres = thres * (np.max(y) - np.min(y)) + np.min(y)
+
+    min_dist = int(min_dist)
+
+    dy = np.diff(y)
+
+    zeros, = np.where(dy == 0)
+
+    if len(zeros) == len(y) - 1:
+        return np.array([])
+
+    if len(zeros):
+        zeros_diff = np.diff(zeros)
+        zeros_diff_not_one, = np.add(np.where(zeros_diff != 1), 1)
+        zero_plateaus = np.split(zeros, zeros_diff_not_one)
+
+        if zero_plateaus[0][0] == 0:
+            dy[zero_plateaus[0]] = dy[zero_plateaus[0][-1] + 1]
+            zero_plateaus.pop(0)
+
+        if len(zero_plateaus) and zero_plateaus[-1][-1] == len(dy) - 1:
+            dy[zero_plateaus[-1]] = dy[zero_plateaus[-1][0] - 1]
+            zero_plateaus.pop(-1)
+
+        for plateau in zero_plateaus:
+            median = np.median(plateau)
+            dy[plateau[plateau < median]] = dy[plateau[0] - 1]
+            dy[plateau[plateau >= median]] = dy[plateau[-1] + 1]
+
+    peaks = np.where(
+        (np.hstack([dy, 0.0]) < 0.0)
+        & (np.hstack([0.0, dy]) > 0.0)
+        & (np.greater(y, thres))
+    )[0]
+
+    if peaks.size > 1 and min_dist > 1:
+        highest = peaks[np.argsort(y[peaks])][::-1]
+        rem = np.ones(y.size, dtype=bool)
+        rem[peaks] = False
+
+        for peak in highest:
+            if not rem[peak]:
+                sl = slice(max(0, peak - min_dist), peak + min_dist + 1)
+                rem[sl] = True
+                rem[peak] = False
+
+        peaks = np.arange(y.size)[~rem]
+
+    return peaks
+
+
+def assert_same(y, thres, min_dist):
+    #both modify dy in place, not y, but give each its own copy anyway
+    expected = reference_peakIndexes(y.copy(), thres, min_dist)
+    got = peakIndexes(y.copy(), thres, min_dist)
+    assert got.dtype == expected.dtype
+    np.testing.assert_array_equal(got, expected)
+
+
+def lines(rng, n):
+    #a few gaussian emission lines on a noisy background
+    x = np.arange(n)
+    y = sum(rng.uniform(20, 250) * np.exp(-0.5 * ((x - c) / rng.uniform(1, 8))**2)
+            for c in rng.uniform(0, n, rng.integers(1, 30)))
+    return y + rng.normal(0, 3, n)
+
+
+SIGNALS = {
+    'random': lambda rng, n: rng.integers(0, 256, n),
+    'saturated': lambda rng, n: np.clip(rng.normal(128, 80, n), 0, 255).astype(int),
+    'flat_topped': lambda rng, n: np.clip(lines(rng, n), 0, 120).astype(int),
+    'quantized_uint8': lambda rng, n: rng.integers(0, 4, n).astype(np.uint8),
+    'float': lambda rng, n: (rng.random(n) * 10).round(1),
+    'smoothed': lambda rng, n: savitzky_golay(np.clip(lines(rng, n), 0, 255), 17, 7).astype(int),
+}
+
+
+@pytest.mark.parametrize('kind', SIGNALS)
+@pytest.mark.parametrize('min_dist', MIN_DISTS)
+def test_synthetic(kind, min_dist):
+    rng = np.random.default_rng(min_dist)
+    for n in (5, 17, 100, 800, 1920):
+        if kind == 'smoothed' and n < 17:
+            continue #shorter than the filter window
+        for _ in range(5):
+            y = SIGNALS[kind](rng, n)
+            assert_same(y, rng.uniform(0, 1), min_dist)
+
+
+@pytest.mark.parametrize('n', (800, 1920, 4000))
+@pytest.mark.parametrize('min_dist', (2, 3, 10))
+def test_rising_chain(n, min_dist):
+    #every other pixel a peak, each higher than the last: the slowest case for suppression in rounds
+    y = np.zeros(n)
+    y[1::2] = np.arange(n // 2)
+    assert_same(y, 0.0, min_dist)
+    assert_same(y[::-1].copy(), 0.0, min_dist)
+
+
+def test_flat():
+    assert len(peakIndexes(np.full(100, 7))) == 0
+
+
+def recorded_spectra():
+    #the camera preview strip of spectra and waterfalls saved by the instrument
+    for path in sorted(MEDIA.glob('spectrum-*.png')) + sorted(MEDIA.glob('waterfall-*.png')):
+        gray = cv2.cvtColor(cv2.imread(str(path)), cv2.COLOR_BGR2GRAY)
+        for row in range(85, 155, 10):
+            yield path.name, row, gray[row:row + 3].mean(axis=0).astype(int)
+
+
+@pytest.mark.parametrize('min_dist', MIN_DISTS)
+def test_recorded(min_dist):
+    spectra = list(recorded_spectra())
+    assert spectra
+    for name, row, raw in spectra:
+        smoothed = savitzky_golay(raw, 17, 7).astype(int)
+        for y in (raw, smoothed):
+            assert_same(y, 20 / max(1, y.max()), min_dist)